@@ -0,0 +1,65 @@
+# Run from the repository root with `TOASTY_CONFIG=... PYTHONPATH=src python benchmarks/extract.py`.
+# The fixtures are synthetic: generated pages laid out like a chat room info page and a chat account page,
+# not pages saved from chat. Where the card container sits decides how much the early exit saves, so each
+# page is also timed with its container moved to the end, which is the most the new extractor can read.
+from pathlib import Path
+from timeit import repeat
+
+from bs4 import BeautifulSoup, Tag
+from lxml import html
+
+from toastyserver.extract import ownedRooms, roomOwners
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+# the BeautifulSoup scrapers these replaced, kept around to compare against
+def soupRoomOwners(page: bytes) -> list[int]:
+    soup = BeautifulSoup(page, features="lxml")
+    assert isinstance(cards := soup.find(id="room-ownercards"), Tag)
+    return [
+        int(tag.attrs["id"].removeprefix("owner-user-"))
+        for tag in cards.find_all(class_="usercard")
+        if isinstance(tag, Tag)
+    ]
+
+
+def soupOwnedRooms(page: bytes) -> list[tuple[int, str]]:
+    soup = BeautifulSoup(page, features="lxml")
+    assert isinstance(cards := soup.find(id="user-owningcards"), Tag | None)
+    if cards is None:
+        return []
+    rooms = []
+    for tag in cards.find_all(class_="roomcard"):
+        if not isinstance(tag, Tag):
+            continue
+        if "frozen" in tag.get_attribute_list("class"):
+            continue
+        assert isinstance(name := tag.find("span", class_="room-name"), Tag)
+        rooms.append((int(tag.attrs["id"].removeprefix("room-")), name.attrs["title"]))
+    return rooms
+
+
+def containerLast(page: bytes, ident: str) -> bytes:
+    document = html.fromstring(page)
+    if (container := document.get_element_by_id(ident, None)) is not None:
+        container.getparent().remove(container)
+        document.body.append(container)
+    return html.tostring(document, doctype="<!DOCTYPE html>")
+
+
+def bench(name: str, page: bytes, old, new, number: int = 20):
+    assert old(page) == new(page), f"{name}: extractor disagrees with BeautifulSoup"
+    before = min(repeat(lambda: old(page), number=number, repeat=5)) / number
+    after = min(repeat(lambda: new(page), number=number, repeat=5)) / number
+    print(f"{name:<18} {len(page) / 1024:>6.0f} KiB  bs4 {before * 1000:>7.2f}ms  lxml {after * 1000:>6.2f}ms  {before / after:>5.1f}x")
+
+
+if __name__ == "__main__":
+    for name, fixture, ident, old, new in [
+        ("room owners", "room-info.html", "room-ownercards", soupRoomOwners, roomOwners),
+        ("owned rooms", "account.html", "user-owningcards", soupOwnedRooms, ownedRooms),
+    ]:
+        page = (FIXTURES / fixture).read_bytes()
+        bench(name, page, old, new)
+        bench(f"{name}, last", containerLast(page, ident), old, new)
@@ -1,22 +1,31 @@
+from typing import Awaitable, Optional, TypeVar
 from datetime import datetime, timedelta
 from os import environ
 from urllib.parse import urlencode, urljoin, urlsplit
 from http.client import responses
-from asyncio import wait_for
+from asyncio import CancelledError, Task, create_task, gather, sleep, wait_for
+from time import perf_counter
 from string import printable
 
-from quart import Quart, g, render_template, request, redirect, abort, flash, url_for
+from quart import Quart, Response, render_template, stream_template, request, redirect, abort, flash, url_for, g
 from werkzeug.exceptions import HTTPException
 from sechat import Credentials, Room
 from odmantic import AIOEngine
 from motor.motor_asyncio import AsyncIOMotorClient
-from aiohttp import ClientSession
 from pydantic import ValidationError
 
 from toastyserver.antifreezer import Antifreezer
 from toastyserver.roommanager import RoomManager
 from toastyserver.usermanager import UserManager
+from toastyserver.jobmanager import JobManager
+from toastyserver.importer import RoomImporter
 from toastyserver.jankapi import JankApi
+from toastyserver.httppool import HttpPool
+from toastyserver.ratelimit import RateLimiter
+from toastyserver.cache import TTLCache
+from toastyserver.indexes import ensureIndexes
+from toastyserver.sitemap import SiteMap
+from toastyserver import metrics
 from toastyserver.models import (
     Role,
     NewRoomForm,
@@ -24,50 +33,152 @@ from toastyserver.models import (
     AntifreezeRoom,
     EditRoomForm,
     EditUserForm,
-    AntifreezeResult,
+    ImportRoomsForm,
+    JobKind,
     Server,
     DEFAULTMSG
 )
 
 antifreezer, bot = None, None
+antifreezerStartup: Optional[Task] = None
 app = Quart(__name__, template_folder="../../templates", static_folder="../../static")
 app.config.from_pyfile(environ["TOASTY_CONFIG"])
 db = AIOEngine(
     AsyncIOMotorClient(app.config["MONGO_URI"]), app.config.get("DATABASE", "toasty")
 )
-usermanager = UserManager(db)
+usermanager = UserManager(
+    db,
+    TTLCache(
+        int(app.config.get("TOKEN_CACHE_SIZE", 1024)),
+        float(app.config.get("TOKEN_CACHE_TTL", 30)),
+    ),
+)
 roommanager = RoomManager(db)
-jankapi = JankApi(usermanager, roommanager)
+jobmanager = JobManager(db)
+importer = RoomImporter(app.config, roommanager, jobmanager, app.logger.getChild("Importer"))
+http = HttpPool(app.config, RateLimiter(app.config))
+scrapes = TTLCache(
+    int(app.config.get("SCRAPE_CACHE_SIZE", 1024)),
+    float(app.config.get("SCRAPE_CACHE_TTL", 5 * 60)),
+)
+jankapi = JankApi(usermanager, roommanager, http, scrapes)
+sitemap = SiteMap(app.config, db, http, app.logger.getChild("SiteMap"))
 app.register_blueprint(jankapi.blueprint)
+metrics.cacheStats("tokens", usermanager.tokens)
+metrics.cacheStats("scrapes", scrapes)
 
 
-@app.while_serving
-async def start():
-    global antifreezer, bot
-    async with ClientSession() as session:
-        async with session.get(
-            "https://api.stackexchange.com/2.3/sites?{}".format(
-                urlencode(
-                    {
-                        "filter": "!b1aoo7vBeKCks8",
-                        "key": app.config["REQUEST_KEY"],
-                    }
-                )
-            )
-        ) as response:
-            g.sitemap = {
-                site["site_url"]: site["api_site_parameter"]
-                for site in (await response.json())["items"]
-            }
+async def databaseQueueDepths():
+    # counted when scraped, so it's right whichever process is asked
+    now = datetime.now()
+    return [(("due rooms",), await roommanager.countDueRooms(now)), (("due jobs",), await jobmanager.countDue(now))]
+
+
+metrics.QUEUE_DEPTH.collect(databaseQueueDepths)
+
+
+T = TypeVar("T")
+
+
+async def timed(phase: str, step: Awaitable[T]) -> T:
+    started = perf_counter()
+    try:
+        return await step
+    finally:
+        app.logger.info(f"Startup: {phase} took {(perf_counter() - started) * 1000:.0f}ms")
+
+
+async def prepareDatabase():
+    await ensureIndexes(
+        db, timedelta(days=int(app.config.get("RUN_RETENTION_DAYS", 90))), app.logger
+    )
+    await roommanager.migrateEmbeddedRuns()
+
+
+async def createAntifreezer() -> Antifreezer:
     credentials = await Credentials.load_or_authenticate(
         "credentials.dat", app.config["BOT_EMAIL"], app.config["BOT_PASSWORD"]
     )
-    antifreezer = Antifreezer(
-        app.config, roommanager, credentials, app.logger.getChild("Antifreezer")
+    return Antifreezer(
+        app.config,
+        roommanager,
+        usermanager,
+        jobmanager,
+        credentials,
+        http,
+        app.logger.getChild("Antifreezer"),
     )
-    await antifreezer.initialSchedule()
+
+
+async def startAntifreezer():
+    global antifreezer
+    # logging in talks to SE, which can be slow or down; keep trying without holding up serving
+    delay = int(app.config.get("LOGIN_RETRY", 30))
+    while True:
+        try:
+            created = await timed("credentials", createAntifreezer())
+        except Exception:
+            app.logger.exception(f"Startup: logging the bot in failed, retrying in {delay}s")
+            await sleep(delay)
+            delay = min(delay * 2, int(app.config.get("LOGIN_RETRY_MAX", 30 * 60)))
+        else:
+            break
+    await timed("scheduler", created.initialSchedule())
+    antifreezer = created
+
+
+@app.while_serving
+async def start():
+    global antifreezerStartup
+    started = perf_counter()
+    # with this turned off the sweep runs in `python -m toastyserver scheduler` instead, which also owns the
+    # bot login and the database bootstrap; web workers only hand it work through the job queue
+    embedded = app.config.get("EMBEDDED_SCHEDULER", True)
+    # none of these depend on each other, and none of them wait on the SE API
+    steps = [timed("site map", sitemap.load())]
+    if embedded:
+        steps.append(timed("database", prepareDatabase()))
+    await gather(*steps)
+    sitemap.start()
+    if embedded:
+        antifreezerStartup = create_task(startAntifreezer())
+    app.logger.info(f"Startup: ready after {(perf_counter() - started) * 1000:.0f}ms")
     yield
-    antifreezer.shutdown()
+    await sitemap.shutdown()
+    if antifreezerStartup is not None and not antifreezerStartup.done():
+        antifreezerStartup.cancel()
+        try:
+            await antifreezerStartup
+        except CancelledError:
+            pass
+    if antifreezer is not None:
+        await antifreezer.shutdown()
+    await http.close()
+
+
+# until the bot has logged in (or when the sweep runs elsewhere) the scheduler picks these up on its own
+def wakeJobs():
+    if antifreezer is not None:
+        antifreezer.wakeJobs()
+
+
+def addAntifreeze(roomId: int):
+    if antifreezer is not None:
+        antifreezer.addAntifreeze(roomId)
+
+
+@app.before_request
+async def startTimer():
+    g.started = perf_counter()
+
+
+@app.after_request
+async def recordLatency(response: Response):
+    if (started := g.get("started")) is not None:
+        metrics.ROUTE_LATENCY.observe(
+            perf_counter() - started, request.endpoint or "unmatched", request.method, str(response.status_code)
+        )
+    return response
 
 
 @app.errorhandler(HTTPException)
@@ -123,98 +234,96 @@ async def seLogin():
 async def finalizeSeLogin():
     if "code" not in request.args:
         abort(400)
-    async with ClientSession() as session:
-        async with session.post(
-            "https://stackoverflow.com/oauth/access_token/json",
-            data={
-                "client_id": app.config["CLIENT_ID"],
-                "client_secret": app.config["CLIENT_SECRET"],
-                "code": request.args["code"],
-                "redirect_uri": urljoin(
-                    app.config["DOMAIN"], url_for("finalizeSeLogin")
-                ),
-            },
-        ) as response:
-            if response.status != 200:
-                app.logger.warning(f"Got {response.status} response from SE auth API: {await response.text()}")
-                abort(400)
-            token = (await response.json())["access_token"]
-        async with session.get(
-            "https://api.stackexchange.com/2.3/me/associated?{}".format(
-                urlencode(
-                    {
-                        "types": "main_site",
-                        "access_token": token,
-                        "key": app.config["REQUEST_KEY"],
-                        "page_size": 100,
-                        "filter": "!nNPvSNPWJ9",
-                    }
-                )
+    async with http.session("https://stackoverflow.com").post(
+        "https://stackoverflow.com/oauth/access_token/json",
+        data={
+            "client_id": app.config["CLIENT_ID"],
+            "client_secret": app.config["CLIENT_SECRET"],
+            "code": request.args["code"],
+            "redirect_uri": urljoin(
+                app.config["DOMAIN"], url_for("finalizeSeLogin")
+            ),
+        },
+    ) as response:
+        if response.status != 200:
+            app.logger.warning(f"Got {response.status} response from SE auth API: {await response.text()}")
+            abort(400)
+        token = (await response.json())["access_token"]
+    async with http.session("https://api.stackexchange.com").get(
+        "https://api.stackexchange.com/2.3/me/associated?{}".format(
+            urlencode(
+                {
+                    "types": "main_site",
+                    "access_token": token,
+                    "key": app.config["REQUEST_KEY"],
+                    "page_size": 100,
+                    "filter": "!nNPvSNPWJ9",
+                }
             )
-        ) as response:
-            sites = (await response.json())["items"]
-            userId = sites[0]["account_id"]
-        app.logger.info(f"Logging in user {userId}")
-        async with session.get(
-            "https://api.stackexchange.com/2.3/me?{}".format(
-                urlencode(
-                    {
-                        "access_token": token,
-                        "key": app.config["REQUEST_KEY"],
-                        "filter": "!AhdF6aF0yuI-5W*KWVlNz",
-                        "site": "meta"
-                        if "https://meta.stackexchange.com"
-                        in [site["site_url"] for site in sites]
-                        else g.sitemap[
-                            sorted(sites, key=lambda site: site["creation_date"])[0][
-                                "site_url"
-                            ]
-                        ],
-                    }
-                )
+        )
+    ) as response:
+        sites = (await response.json())["items"]
+        userId = sites[0]["account_id"]
+    app.logger.info(f"Logging in user {userId}")
+    if "https://meta.stackexchange.com" in [site["site_url"] for site in sites]:
+        apiSite = "meta"
+    elif (apiSite := await sitemap.lookup(sorted(sites, key=lambda site: site["creation_date"])[0]["site_url"])) is None:
+        app.logger.warning(f"Login failed for user {userId}: their oldest site isn't in the site map")
+        await flash("Failed to log in: couldn't look up your Stack Exchange site. Please try again later.", "error")
+        return redirect(url_for("index"))
+    async with http.session("https://api.stackexchange.com").get(
+        "https://api.stackexchange.com/2.3/me?{}".format(
+            urlencode(
+                {
+                    "access_token": token,
+                    "key": app.config["REQUEST_KEY"],
+                    "filter": "!AhdF6aF0yuI-5W*KWVlNz",
+                    "site": apiSite,
+                }
             )
-        ) as response:
-            userName = (await response.json())["items"][0]["display_name"][:16]
-
-        now = datetime.now()
-        isModerator = any(site["user_type"] == "moderator" for site in sites)
-        async with db.session() as dbSession:
-            if not await usermanager.userExists(userId, dbSession):
-                app.logger.info(f"Creating account for user {userId}")
-                if not any(site["reputation"] >= 200 for site in sites):
-                    app.logger.info("Account creation failed: insufficient reputation")
-                    await flash(
-                        "Failed to create account: Insufficient reputation!", "error"
-                    )
+        )
+    ) as response:
+        userName = (await response.json())["items"][0]["display_name"][:16]
+
+    now = datetime.now()
+    isModerator = any(site["user_type"] == "moderator" for site in sites)
+    async with db.session() as dbSession:
+        if not await usermanager.userExists(userId, dbSession):
+            app.logger.info(f"Creating account for user {userId}")
+            if not any(site["reputation"] >= 200 for site in sites):
+                app.logger.info("Account creation failed: insufficient reputation")
+                await flash(
+                    "Failed to create account: Insufficient reputation!", "error"
+                )
+                return redirect(url_for("index"))
+            async with http.session("https://chat.stackexchange.com").get(
+                f"https://chat.stackexchange.com/account/{userId}", allow_redirects=False
+            ) as response:
+                if response.status != 302:
+                    app.logger.info("Account creation failed: no chat account")
+                    await flash("Failed to create account: You do not have a chat account.", "error")
                     return redirect(url_for("index"))
-                async with session.get(
-                    f"https://chat.stackexchange.com/account/{userId}", allow_redirects=False
-                ) as response:
-                    if response.status != 302:
-                        app.logger.info("Account creation failed: no chat account")
-                        await flash("Failed to create account: You do not have a chat account.", "error")
-                        return redirect(url_for("index"))
-                    chatIdent = int(
-                        response.headers["location"].removeprefix("/").split("/")[1]
-                    )
-                await usermanager.saveUser(
-                    user := User( # type: ignore
-                        ident=userId,
-                        chatIdent=chatIdent,
-                        name=userName,
-                        role=Role.MODERATOR if isModerator else Role.USER,
-                        created=now,
-                    ),
-                    dbSession,
+                chatIdent = int(
+                    response.headers["location"].removeprefix("/").split("/")[1]
                 )
-                app.logger.info(f"Account created for user {userId} ({userName}, chat {chatIdent})")
-                await flash("Account created!", "success")
-            else:
-                user = await usermanager.getUser(userId, dbSession)
-                assert user is not None
-                await flash("Logged in successfully.", "success")
-            app.logger.info(f"Issuing token for {userId} ({userName})")
-            token = await usermanager.issueToken(user, now, now + timedelta(30))
+            await usermanager.saveUser(
+                user := User( # type: ignore
+                    ident=userId,
+                    chatIdent=chatIdent,
+                    name=userName,
+                    role=Role.MODERATOR if isModerator else Role.USER,
+                    created=now,
+                ),
+                dbSession,
+            )
+            app.logger.info(f"Account created for user {userId} ({userName}, chat {chatIdent})")
+            await flash("Account created!", "success")
+        else:
+            user = await usermanager.getUser(userId, dbSession)
+            assert user is not None
+            await flash("Logged in successfully.", "success")
+        app.logger.info(f"Issuing token for {userId} ({userName})")
+        token = await usermanager.issueToken(user, now, now + timedelta(30))
 
     response = redirect(
         url_for("index")
@@ -237,12 +346,32 @@ async def logout(user):
     return response
 
 
+def pageLimit() -> int:
+    limit = request.args.get("limit", int(app.config.get("PAGE_SIZE", 100)), type=int)
+    return max(1, min(limit, int(app.config.get("MAX_PAGE_SIZE", 500))))
+
+
+def roomCursor() -> Optional[tuple[str, int]]:
+    if (name := request.args.get("after")) is None or (roomId := request.args.get("afterId", type=int)) is None:
+        return None
+    return name, roomId
+
+
+async def renderListing(template: str, **context):
+    # listings are handed over as cursors, so streaming lets the first rows out before the last are fetched
+    if app.config.get("STREAM_LISTINGS", False):
+        return await stream_template(template, **context)
+    return await render_template(template, **context)
+
+
 @app.route("/rooms/")
 @usermanager.requireUser()
 async def myRooms(user):
-    return await render_template(
+    limit = pageLimit()
+    return await renderListing(
         "rooms.html",
-        rooms=[room async for room in roommanager.getRoomsOfUser(user)],
+        rooms=roommanager.getRoomSummariesOfUser(user, roomCursor(), limit),
+        limit=limit,
         title="My rooms",
         activePage="myRooms",
         showUsers=False,
@@ -253,19 +382,11 @@ async def myRooms(user):
 @app.route("/rooms/all/")
 @usermanager.requireUser(Role.MODERATOR)
 async def allRooms(user):
-    rooms = []
-    users: dict[int, User] = {}
-    async with db.session() as session:
-        async for room in roommanager.allRooms():
-            if room.addedBy not in users:
-                assert (
-                    roomUser := await usermanager.getUser(room.addedBy, session)
-                ) is not None
-                users[room.addedBy] = roomUser
-            rooms.append((room, users[room.addedBy]))
-    return await render_template(
+    limit = pageLimit()
+    return await renderListing(
         "rooms.html",
-        rooms=sorted(rooms, key=lambda r: r[0].name),
+        rooms=roommanager.allRoomSummariesWithUsers(roomCursor(), limit),
+        limit=limit,
         title="All rooms",
         activePage="allRooms",
         showUsers=True,
@@ -285,21 +406,17 @@ async def roomDetails(roomId: int, user: User):
         addedBy = await usermanager.getUser(room.addedBy)
     else:
         addedBy = None
+    runs = await roommanager.getRuns(roomId)
     return await render_template(
         "room-details.html",
         user=user,
         room=room,
         addedBy=addedBy,
-        lastChecked=room.runs[0].ranAt if len(room.runs) else None,
-        lastAntifreezed=i[0].ranAt
-        if len(
-            i := list(
-                filter(
-                    lambda run: run.result == AntifreezeResult.ANTIFREEZED, room.runs
-                )
-            )
-        )
-        else None,
+        runs=runs,
+        timings=metrics.phasePercentiles((run.duration, run.phases) for run in runs),
+        job=await jobmanager.latestForRoom(roomId),
+        lastChecked=room.lastChecked,
+        lastAntifreezed=room.lastAntifreezed,
         form={"message": room.message, "active": room.active, "locked": room.locked},
     )
 
@@ -328,10 +445,7 @@ async def editRoom(roomId: int, user: User):
     form.message = "".join(char for char in form.message if char in printable).strip()
     if len(form.message) <= 0:
         form.message = DEFAULTMSG
-    room.message = form.message
-    room.active = form.active
-    room.locked = form.locked
-    await roommanager.saveRoom(room)
+    await roommanager.updateRoom(roomId, message=form.message, active=form.active, locked=form.locked)
     await flash("Room edited.", "success")
     return redirect(url_for("myRooms"))
 
@@ -339,7 +453,6 @@ async def editRoom(roomId: int, user: User):
 @app.route("/rooms/<int:roomId>/delete", methods=["POST"])
 @usermanager.requireUser(Role.USER)
 async def deleteRoom(roomId: int, user: User):
-    assert antifreezer is not None
     room = await roommanager.getRoom(roomId)
     if room is None:
         abort(404)
@@ -357,7 +470,9 @@ async def deleteRoom(roomId: int, user: User):
         if roomId not in allowedRooms:
             abort(403)
     await roommanager.deleteRoom(room)
-    antifreezer.removeAntifreeze(room.roomId)
+    if antifreezer is not None:
+        antifreezer.removeAntifreeze(room.roomId)
+    jankapi.invalidateRoom(room.roomId, room.server.value)
     await flash("Room deleted.", "warning")
     return redirect(url_for("myRooms"))
 
@@ -365,26 +480,22 @@ async def deleteRoom(roomId: int, user: User):
 @app.route("/rooms/<int:roomId>/forcecheck", methods=["POST"])
 @usermanager.requireUser(Role.DEVELOPER)
 async def forceCheck(user: User, roomId: int):
-    assert antifreezer is not None
-    await antifreezer.runAntifreeze(roomId)
+    await jobmanager.enqueue(JobKind.CHECK, roomId)
+    wakeJobs()
     return "ok"
 
 
 @app.route("/rooms/<int:roomId>/clearerrors", methods=["POST"])
 @usermanager.requireUser()
 async def clearErrors(user: User, roomId: int):
-    room = await roommanager.getRoom(roomId)
-    if room is None:
+    if not await roommanager.updateRoom(roomId, pendingErrors=0):
         abort(404)
-    room.pendingErrors = 0
-    await roommanager.saveRoom(room)
     return "ok"
 
 
 @app.route("/rooms/new", methods=["GET", "POST"])
 @usermanager.requireUser(Role.USER)
 async def newRoom(user: User):
-    assert antifreezer is not None
     if request.method == "GET":
         return await render_template("add-room.html", user=user)
     else:
@@ -395,14 +506,18 @@ async def newRoom(user: User):
         if form.server != Server.STACK_EXCHANGE:
             abort(400) # TODO
         if user.role < Role.MODERATOR:
-            allowedRooms = [
-                ident
+            allowedRooms = {
+                ident: name
                 async for ident, name in jankapi.getUserOwnedRooms(
                     user, form.server.value
                 )
-            ]
+            }
             if form.room not in allowedRooms:
                 abort(403)
+            name = allowedRooms[form.room]
+        else:
+            # filled in by the onboarding job
+            name = f"Room #{form.room}"
         if len(form.message) > 128:
             abort(400)
         form.message = "".join(char for char in form.message if char in printable).strip()
@@ -410,31 +525,85 @@ async def newRoom(user: User):
             form.message = DEFAULTMSG
         if user.role < Role.MODERATOR:
             form.locked = False
-        await antifreezer.notifyRoomAdded(form.room, user)
-        details = await antifreezer.getRoomDetails(form.room, form.server.value)
         await roommanager.saveRoom(
             AntifreezeRoom( # type: ignore
                 roomId=form.room,
                 server=form.server,
-                name=details.name,
+                name=name,
                 active=form.active,
                 locked=form.locked,
                 addedBy=user.ident,
                 message=form.message,
+                nextRunAt=datetime.now() + timedelta(hours=int(app.config.get("CHECK_INTERVAL", 24))),
             )
         )
-        await antifreezer.runAntifreeze(form.room)
-        antifreezer.scheduleAntifreeze(form.room)
-        await flash("Room added!", "success")
+        # announcing the room, fetching its details and the first check all talk to chat, so they happen in the background
+        await jobmanager.enqueue(JobKind.ONBOARD, form.room)
+        wakeJobs()
+        addAntifreeze(form.room)
+        jankapi.invalidateRoom(form.room, form.server.value)
+        await flash("Room added! It will be set up in the background.", "success")
         return redirect(url_for("roomDetails", roomId=form.room))
 
 
+@app.route("/rooms/import", methods=["GET", "POST"])
+@usermanager.requireUser(Role.MODERATOR)
+async def importRooms(user: User):
+    if request.method == "GET":
+        return await render_template("import-rooms.html", user=user, activePage="importRooms")
+    submitted = await request.form
+
+    async def rejected(message: str):
+        # show the form again as it was sent, so a typo doesn't cost the whole list
+        await flash(message, "error")
+        return (
+            await render_template(
+                "import-rooms.html",
+                user=user,
+                activePage="importRooms",
+                rooms=submitted.get("rooms", ""),
+                form={
+                    "message": submitted.get("message", ""),
+                    "active": "active" in submitted,
+                    "locked": "locked" in submitted,
+                },
+            ),
+            400,
+        )
+
+    try:
+        form = ImportRoomsForm(**submitted)
+    except ValidationError:
+        return await rejected("Room IDs must be numbers, separated by spaces, commas or newlines.")
+    if form.server != Server.STACK_EXCHANGE:
+        return await rejected("Only Stack Exchange chat rooms can be imported.")
+    roomIds = list(dict.fromkeys(form.rooms))
+    if not len(roomIds):
+        return await rejected("No room IDs were given.")
+    if len(roomIds) > (limit := int(app.config.get("IMPORT_LIMIT", 500))):
+        return await rejected(f"At most {limit} rooms can be imported at once; {len(roomIds)} were given.")
+    if len(form.message) > 128:
+        return await rejected("The antifreeze message can be at most 128 characters.")
+    form.message = "".join(char for char in form.message if char in printable).strip()
+    if len(form.message) <= 0:
+        form.message = DEFAULTMSG
+    results = await importer.importRooms(roomIds, form.server, user, form.message, form.active, form.locked)
+    wakeJobs()
+    for result in results:
+        if result.error is None:
+            addAntifreeze(result.roomId)
+            jankapi.invalidateRoom(result.roomId, form.server.value)
+    return await render_template("import-rooms.html", user=user, activePage="importRooms", results=results)
+
+
 @app.route("/users/")
 @usermanager.requireUser(Role.MODERATOR)
 async def users(user: User):
-    return await render_template(
+    limit = pageLimit()
+    return await renderListing(
         "users.html",
-        users=[user async for user in await usermanager.allUsers()],
+        users=await usermanager.allUsers(request.args.get("after", type=int), limit),
+        limit=limit,
         user=user,
     )
 
@@ -448,9 +617,11 @@ async def roomsOfUser(userId: int, user: User):
         abort(403)
     if (target := await usermanager.getUser(userId)) is None:
         abort(404)
-    return await render_template(
+    limit = pageLimit()
+    return await renderListing(
         "rooms.html",
-        rooms=[room async for room in roommanager.getRoomsOfUser(target)],
+        rooms=roommanager.getRoomSummariesOfUser(target, roomCursor(), limit),
+        limit=limit,
         title=f"Rooms of {target.name}",
         activePage="rooms",
         showUsers=False,
@@ -499,8 +670,30 @@ async def editUser(userId: int, user: User):
     form.username = "".join(char for char in form.username if char in printable).strip()
     if len(form.username) <= 0:
         abort(400)
-    target.role = form.role
-    target.name = form.username
-    await usermanager.saveUser(target)
+    await usermanager.updateUser(target.ident, role=form.role, name=form.username)
     await flash("User saved.", "success")
     return redirect(url_for("userSettings", userId=userId))
+
+
+@app.route("/runs/slow")
+@usermanager.requireUser(Role.DEVELOPER)
+async def slowRuns(user: User):
+    since = datetime.now() - timedelta(hours=int(app.config.get("SLOW_RUN_WINDOW", 24)))
+    return await render_template(
+        "slow-runs.html",
+        runs=await roommanager.getSlowRuns(since, pageLimit()),
+        percentiles=metrics.phasePercentiles(await roommanager.getRunTimings(since)),
+        since=since,
+        user=user,
+    )
+
+
+@app.route("/metrics")
+@usermanager.provideUser
+async def exportMetrics(user: Optional[User]):
+    # scraped from the box itself, or looked at by a developer; nobody else needs our internals. behind a
+    # reverse proxy on the same box every request looks local, so set METRICS_ADDRESSES to [] there
+    addresses = app.config.get("METRICS_ADDRESSES", ["127.0.0.1", "::1"])
+    if request.remote_addr not in addresses and (user is None or user.role < Role.DEVELOPER):
+        abort(403)
+    return Response(await metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -1,3 +1,64 @@
-from toastyserver import app
+from sys import argv
+from asyncio import Event, gather, get_running_loop, run
+from logging import INFO
+from signal import SIGINT, SIGTERM
 
-app.run("localhost", 3200, debug=True)
\ No newline at end of file
+from aiohttp import web
+
+from toastyserver import app, db, http, importer, metrics, usermanager, prepareDatabase, createAntifreezer, timed
+from toastyserver.indexes import indexReport
+from toastyserver.models import Server, DEFAULTMSG
+
+
+async def reportIndexes():
+    for line in await indexReport(db):
+        print(line)
+
+
+async def importRooms(userId: int, roomIds: list[int]):
+    # rooms are added on behalf of an existing user; the scheduler picks up their import jobs
+    assert (user := await usermanager.getUser(userId)) is not None, f"No user with id {userId}"
+    results = await importer.importRooms(
+        list(dict.fromkeys(roomIds)), Server.STACK_EXCHANGE, user, DEFAULTMSG, True, False
+    )
+    for result in results:
+        print(f"{result.roomId}\t{'ok' if result.error is None else 'failed'}\t{result.name or result.error}")
+
+
+async def serveMetrics(request: web.Request) -> web.Response:
+    return web.Response(body=(await metrics.render()).encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def runScheduler():
+    # the sweep, the job queue and the listener on their own, for when the web app runs with EMBEDDED_SCHEDULER off
+    app.logger.setLevel(INFO)
+    _, antifreezer = await gather(
+        timed("database", prepareDatabase()),
+        timed("credentials", createAntifreezer()),
+    )
+    await antifreezer.initialSchedule()
+    # the checks, jobs and joins all happen in this process, so it has its own /metrics for Prometheus to scrape
+    metricsApp = web.Application()
+    metricsApp.router.add_get("/metrics", serveMetrics)
+    runner = web.AppRunner(metricsApp, access_log=None)
+    await runner.setup()
+    await web.TCPSite(
+        runner, app.config.get("METRICS_HOST", "127.0.0.1"), int(app.config.get("METRICS_PORT", 9320))
+    ).start()
+    stop = Event()
+    for signal in (SIGINT, SIGTERM):
+        get_running_loop().add_signal_handler(signal, stop.set)
+    await stop.wait()
+    await runner.cleanup()
+    await antifreezer.shutdown()
+    await http.close()
+
+
+if argv[1:] == ["indexes"]:
+    run(reportIndexes())
+elif argv[1:] == ["scheduler"]:
+    run(runScheduler())
+elif argv[1:2] == ["import"] and len(argv) > 3:
+    run(importRooms(int(argv[2]), [int(roomId) for roomId in argv[3:]]))
+else:
+    app.run("localhost", 3200, debug=True)
@@ -1,117 +1,426 @@
-from datetime import datetime
+from asyncio import Event, gather
+from json import loads
+from os import getpid
+from socket import gethostname
+from datetime import datetime, timedelta
+from typing import Optional
 from urllib.parse import urljoin
-from aiohttp import ClientSession
-from bs4 import BeautifulSoup, Tag
 
 from pytz import UTC
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.job import Job
-from sechat import Credentials, Room
+from sechat import Credentials
 from sechat.errors import OperationFailedError
 from flask import Config
 from logging import Logger
 
 from toastyserver.roommanager import RoomManager
-from toastyserver.models import AntifreezeRun, AntifreezeResult, RoomDetails, User
+from toastyserver.usermanager import UserManager
+from toastyserver.jobmanager import JobManager
+from toastyserver.httppool import HttpPool
+from toastyserver.chatsession import ChatSession
+from toastyserver.sweeper import Sweeper
+from toastyserver.listener import ActivityListener
+from toastyserver.roompool import RoomPool
+from toastyserver.ratelimit import Throttled
+from toastyserver.extract import roomOwners
+from toastyserver.metrics import CHECK_LATENCY, CHECKS, JOBS, PHASE_LATENCY, QUEUE_DEPTH, Trace, currentTrace, phase
+from toastyserver.models import (
+    AntifreezeRoom,
+    AntifreezeRun,
+    AntifreezeResult,
+    Job,
+    JobKind,
+    JobState,
+    RoomDetails,
+    User,
+)
 
 
 class Antifreezer:
-    def __init__(self, config: Config, manager: RoomManager, credentials: Credentials, logger: Logger):
+    def __init__(
+        self,
+        config: Config,
+        manager: RoomManager,
+        users: UserManager,
+        jobs: JobManager,
+        credentials: Credentials,
+        http: HttpPool,
+        logger: Logger,
+    ):
         self.logger = logger
         self.config = config
         self.manager = manager
+        self.users = users
+        self.jobs = jobs
         self.credentials = credentials
+        self.http = http
+        self.chat = ChatSession(credentials, http.limiter, timedelta(seconds=int(config.get("FKEY_TTL", 60 * 60))))
+        self.rooms = RoomPool(
+            credentials,
+            http.limiter,
+            int(config.get("ROOM_POOL_SIZE", 32)),
+            float(config.get("ROOM_POOL_IDLE", 5 * 60)),
+            logger.getChild("RoomPool"),
+        )
+        self.sweeper = Sweeper(self.runAntifreeze, int(config.get("SWEEP_CONCURRENCY", 4)), logger.getChild("Sweeper"))
         self.scheduler = AsyncIOScheduler(timezone=UTC)
-        self.roomJobs: dict[int, Job] = {}
+        self.checkInterval = timedelta(hours=int(config.get("CHECK_INTERVAL", 24)))
+        self.metadataInterval = timedelta(hours=int(config.get("METADATA_REFRESH", 72)))
+        # rooms are leased to one instance at a time, so replicas can share the sweep
+        self.instance = str(config.get("INSTANCE_ID", f"{gethostname()}:{getpid()}"))
+        self.leaseTTL = timedelta(seconds=int(config.get("LEASE_TTL", 2 * 60)))
+        self.leases: set[int] = set()
+        # leases are held per instance, so checks within this one take turns here
+        self.checking: dict[int, Event] = {}
+        self.listener = (
+            ActivityListener(credentials, manager, http.limiter, logger.getChild("Listener"))
+            if config.get("LIVE_ACTIVITY", False)
+            else None
+        )
+        QUEUE_DEPTH.collect(self.queueDepths)
+
+    def queueDepths(self):
+        yield ("sweeper",), self.sweeper.queue.qsize()
+        yield ("leases",), len(self.leases)
+        if self.listener is not None:
+            yield ("subscriptions",), len(self.listener.subscriptions)
 
     async def initialSchedule(self):
-        async for room in self.manager.allRooms():
-            self.scheduleAntifreeze(room.roomId)
+        # nothing here waits on the database; the catching up happens in the first runs of the jobs
+        self.sweeper.start()
+        self.scheduler.add_job(self.scheduleUnscheduledRooms, next_run_time=datetime.now(UTC))
+        if self.listener is not None:
+            self.scheduler.add_job(
+                self.listener.sync,
+                "interval",
+                seconds=int(self.config.get("LISTENER_SYNC", 60)),
+                max_instances=1,
+                coalesce=True,
+                next_run_time=datetime.now(UTC),
+            )
+        self.scheduler.add_job(
+            self.pollDueRooms,
+            "interval",
+            seconds=int(self.config.get("SCHEDULER_POLL", 30)),
+            max_instances=1,
+            coalesce=True,
+            next_run_time=datetime.now(UTC),
+        )
+        self.scheduler.add_job(
+            self.renewLeases,
+            "interval",
+            seconds=self.leaseTTL.total_seconds() / 3,
+            max_instances=1,
+            coalesce=True,
+        )
+        self.scheduler.add_job(
+            self.pollJobs,
+            "interval",
+            id="jobs",
+            seconds=int(self.config.get("JOB_POLL", 5)),
+            max_instances=1,
+            coalesce=True,
+            next_run_time=datetime.now(UTC),
+        )
+        self.scheduler.add_job(
+            self.rooms.evictIdle,
+            "interval",
+            seconds=self.rooms.idleTimeout,
+            max_instances=1,
+            coalesce=True,
+        )
         self.scheduler.start()
 
-    def shutdown(self):
-        self.scheduler.shutdown()
+    async def scheduleUnscheduledRooms(self):
+        await self.manager.scheduleUnscheduledRooms(
+            datetime.now(), timedelta(seconds=int(self.config.get("SWEEP_WINDOW", 60 * 60)))
+        )
+
+    async def shutdown(self):
+        if self.scheduler.running:
+            self.scheduler.shutdown()
+        await self.sweeper.shutdown()
+        if self.listener is not None:
+            await self.listener.shutdown()
+        await self.rooms.close()
+        await self.chat.close()
+        # hand anything we were still holding straight to the other instances instead of making them wait it out
+        await self.manager.releaseLeases(self.instance)
+        self.leases.clear()
+
+    async def renewLeases(self):
+        if len(self.leases):
+            await self.manager.renewLeases(self.instance, list(self.leases), datetime.now() + self.leaseTTL)
+
+    async def pollDueRooms(self):
+        batch = int(self.config.get("SCHEDULER_BATCH", 50))
+        claimTimeout = timedelta(seconds=int(self.config.get("SCHEDULER_CLAIM_TIMEOUT", 60 * 60)))
+        # only claim as much as the sweeper can get through soon; the rest stays due in the database
+        while self.sweeper.queue.qsize() < batch:
+            now = datetime.now()
+            rooms = await self.manager.claimDueRooms(self.instance, now, now + self.leaseTTL, now + claimTimeout, batch)
+            for roomId in rooms:
+                self.leases.add(roomId)
+                self.sweeper.submit(roomId)
+            if len(rooms) < batch:
+                break
+
+    def wakeJobs(self):
+        # don't leave a freshly queued job waiting for the next poll, if the poll is in this process
+        if self.scheduler.running:
+            self.scheduler.modify_job("jobs", next_run_time=datetime.now(UTC))
+
+    async def pollJobs(self):
+        concurrency = int(self.config.get("JOB_CONCURRENCY", 4))
+        staleAfter = timedelta(seconds=int(self.config.get("JOB_CLAIM_TIMEOUT", 15 * 60)))
+        while True:
+            jobs = []
+            while len(jobs) < concurrency:
+                now = datetime.now()
+                if (job := await self.jobs.claim(now, now - staleAfter)) is None:
+                    break
+                jobs.append(job)
+            if not len(jobs):
+                break
+            await gather(*(self.runJob(job) for job in jobs))
+
+    async def runJob(self, job: Job):
+        logger = self.logger.getChild(f"Job{job.id}")
+        logger.info(f"Running {job.kind.name.lower()} for room {job.roomId} (attempt {job.attempts})")
+        try:
+            match job.kind:
+                case JobKind.ONBOARD:
+                    await self.onboardRoom(job)
+                case JobKind.NOTIFY:
+                    if (room := await self.manager.getRoom(job.roomId)) is not None:
+                        await self.announceRoom(job, room)
+                case JobKind.CHECK:
+                    await self.runAntifreeze(job.roomId, force=True)
+                case JobKind.IMPORT:
+                    await self.finishImport(job)
+        except Throttled as error:
+            logger.warning(f"Throttled by {error.server}, retrying in {error.retryAfter}s")
+            JOBS.inc(job.kind.name.lower(), "throttled")
+            await self.jobs.retry(job, f"Throttled by {error.server}", datetime.now() + timedelta(seconds=error.retryAfter))
+        except Exception as error:
+            logger.exception("Job failed")
+            if job.attempts >= int(self.config.get("JOB_MAX_ATTEMPTS", 5)):
+                JOBS.inc(job.kind.name.lower(), "failed")
+                await self.jobs.finish(job, JobState.FAILED, repr(error))
+            else:
+                JOBS.inc(job.kind.name.lower(), "retried")
+                backoff = int(self.config.get("JOB_BACKOFF", 30)) * 2 ** (job.attempts - 1)
+                await self.jobs.retry(job, repr(error), datetime.now() + timedelta(seconds=backoff))
+        else:
+            JOBS.inc(job.kind.name.lower(), "done")
+            await self.jobs.finish(job, JobState.DONE)
+
+    async def onboardRoom(self, job: Job):
+        # each step is recorded as it completes, so a retry doesn't announce the room twice
+        if (room := await self.manager.getRoom(job.roomId)) is None:
+            return
+        await self.announceRoom(job, room)
+        if "details" not in job.steps:
+            details = await self.getRoomDetails(room.roomId, room.server.value)
+            await self.manager.updateRoom(room.roomId, name=details.name)
+            await self.jobs.markStep(job, "details")
+        await self.runAntifreeze(room.roomId)
+        await self.jobs.markStep(job, "checked")
 
-    def scheduleAntifreeze(self, roomId: int):
-        self.logger.info(f"Antifreeze scheduled for room {roomId}")
-        self.roomJobs[roomId] = self.scheduler.add_job(
-            self.runAntifreeze, "cron", (roomId,), hour=0, jitter=60 * 60
-        )  # Antifreeze jobs will execute over a 3-hour time window
+    async def finishImport(self, job: Job):
+        # imported rooms already have their first check staggered over the sweep, so this only fills in the rest
+        if (room := await self.manager.getRoom(job.roomId)) is None:
+            return
+        if "details" not in job.steps:
+            details = await self.getRoomDetails(room.roomId, room.server.value)
+            await self.manager.updateRoom(room.roomId, name=details.name)
+            await self.jobs.markStep(job, "details")
+        await self.announceRoom(job, room)
+
+    async def announceRoom(self, job: Job, room: AntifreezeRoom):
+        if "notified" in job.steps:
+            return
+        if (user := await self.users.getUser(room.addedBy)) is not None:
+            await self.notifyRoomAdded(room.roomId, user)
+        await self.jobs.markStep(job, "notified")
 
     async def notifyRoomAdded(self, roomId: int, user: User):
-        async with await Room.join(self.credentials, roomId) as room:
-            try:
-                await room.send(
-                    f"Toasty Antifreeze has been enabled on this room by [{user.name}](https://chat.stackexchange.com/users/{user.chatIdent})."
-                    f" Moderators or owners of this room can edit or disable antifreezing [here]({self.config['DOMAIN']}/rooms/{roomId})."
-                )
-            except OperationFailedError:
-                pass
+        try:
+            await self.rooms.send(
+                roomId,
+                f"Toasty Antifreeze has been enabled on this room by [{user.name}](https://chat.stackexchange.com/users/{user.chatIdent})."
+                f" Moderators or owners of this room can edit or disable antifreezing [here]({self.config['DOMAIN']}/rooms/{roomId})."
+            )
+        except OperationFailedError:
+            pass
+
+    # shortcuts for when the sweep runs in this process; otherwise the scheduler catches up on its own
+
+    def addAntifreeze(self, roomId: int):
+        if self.listener is not None and self.scheduler.running:
+            self.listener.subscribe(roomId)
 
     def removeAntifreeze(self, roomId: int):
         self.logger.info(f"Antifreeze removed for room {roomId}")
-        self.scheduler.remove_job(self.roomJobs[roomId].id)
+        self.sweeper.cancel(roomId)
+        self.leases.discard(roomId)
+        if self.listener is not None and self.scheduler.running:
+            self.listener.unsubscribe(roomId)
 
     async def lastMessageInRoom(self, roomId: int) -> datetime:
-        async with self.credentials.session() as session:
-            fkey = await Credentials.scrape_fkey(session, self.credentials.server)
-            async with session.post(
-                f"/chats/{roomId}/events",
-                data={"since": 0, "mode": "Messages", "msgCount": 100, "fkey": fkey},
-            ) as response:
-                # Ginger, please remember the 21st night of September
-                humanMessages = list(filter(lambda msg: msg["user_id"] > 0, (await response.json())["events"]))
-                if not len(humanMessages):
-                    return datetime.fromtimestamp(0) # unfortunate hack
-                latestMessage = humanMessages[-1]
-        return datetime.fromtimestamp(latestMessage["time_stamp"])
+        if self.listener is None:
+            return await self.pollLastMessage(roomId)
+        if (lastActivity := self.listener.lastActivity(roomId)) is not None:
+            return lastActivity
+        lastMessage = await self.pollLastMessage(roomId)
+        self.listener.seed(roomId, lastMessage)
+        return lastMessage
+
+    async def pollLastMessage(self, roomId: int) -> datetime:
+        # most rooms have a human message among their last few events, so start with a small window and
+        # only page further back (in bigger steps) for rooms that are mostly feeds and bots
+        count = int(self.config.get("EVENT_WINDOW", 10))
+        maxCount = int(self.config.get("EVENT_WINDOW_MAX", 100))
+        # any younger and an answer from the oldest event seen could say a room is fresher than it is
+        threshold = int(self.config["THRESHOLD"])
+        maxAge = timedelta(days=max(threshold, int(self.config.get("EVENT_MAX_AGE", threshold))))
+        maxPages = max(1, int(self.config.get("EVENT_MAX_PAGES", 4)))
+        data = {"since": 0, "mode": "Messages", "msgCount": count}
+        for _ in range(maxPages):
+            events = (await self.chat.post(f"/chats/{roomId}/events", data))["events"]
+            # Ginger, please remember the 21st night of September
+            for event in reversed(events):
+                if event["user_id"] > 0:
+                    return datetime.fromtimestamp(event["time_stamp"])
+            if len(events) < count:
+                return datetime.fromtimestamp(0) # unfortunate hack
+            oldest = datetime.fromtimestamp(events[0]["time_stamp"])
+            if datetime.now() - oldest >= maxAge:
+                # nobody has spoken since at least then, which is all the threshold needs to know
+                return oldest
+            count = min(count * 4, maxCount)
+            data = {"since": 0, "mode": "Messages", "msgCount": count, "before": events[0]["message_id"]}
+        # rooms that are nothing but feeds would otherwise be paged all the way back every check. the last human
+        # message is somewhere before everything we saw, so we can't say when the room freezes; antifreeze it
+        # rather than guess
+        return datetime.fromtimestamp(0)
 
     async def getRoomDetails(self, ident: int, server: str) -> RoomDetails:
-        async with ClientSession() as session, session.get(urljoin(server, f"/rooms/thumbs/{ident}")) as response:
-                json = await response.json()
+        async with self.http.session(server, throttled=True).get(urljoin(server, f"/rooms/thumbs/{ident}")) as response:
+            json = await response.json()
         return RoomDetails(
             ident=int(json["id"]),
             name=json["name"],
             description=json["description"]
         )
 
-    async def getOwnersOfRoom(self, room: int, server: str):
-        async with ClientSession() as session, session.get(
-            urljoin(server, f"/rooms/info/{room}")
-        ) as response:
-            soup = BeautifulSoup(await response.read(), features="lxml")
-        assert isinstance(cards := soup.find(id="room-ownercards"), Tag)
-        for tag in cards.find_all(class_="usercard"):
-            if not isinstance(tag, Tag):
-                continue
-            yield int(tag.attrs["id"].removeprefix("owner-user-"))
-
-    async def runAntifreeze(self, roomId: int):
+    async def refreshMetadata(self, room: AntifreezeRoom) -> dict:
+        # the name and owners hardly ever change, so only parse and write them when chat sends something new
+        server = room.server.value
+        update = {"metadataRefreshedAt": datetime.now()}
+        with phase("thumbs"):
+            thumbs, validators = await self.http.fetchIfChanged(
+                urljoin(server, f"/rooms/thumbs/{room.roomId}"), room.thumbsValidators
+            )
+        if validators != room.thumbsValidators:
+            update["thumbsValidators"] = validators.model_dump_doc()
+        if thumbs is not None and (name := loads(thumbs)["name"]) != room.name:
+            update["name"] = name
+        with phase("info"):
+            info, validators = await self.http.fetchIfChanged(
+                urljoin(server, f"/rooms/info/{room.roomId}"), room.infoValidators
+            )
+        if validators != room.infoValidators:
+            update["infoValidators"] = validators.model_dump_doc()
+        if info is not None and (owners := roomOwners(info)) != room.owners:
+            update["owners"] = owners
+        return update
+
+    async def runAntifreeze(self, roomId: int, force: bool = False):
+        # a forced check or onboarding can land while the sweep is checking the same room; wait for it rather
+        # than both deciding to send
+        while (running := self.checking.get(roomId)) is not None:
+            await running.wait()
+        self.checking[roomId] = Event()
+        try:
+            now = datetime.now()
+            if not await self.manager.acquireLease(roomId, self.instance, now, now + self.leaseTTL):
+                self.logger.info(f"Room {roomId} is being checked by another instance. Skipping.")
+                self.leases.discard(roomId)
+                return
+            self.leases.add(roomId)
+            await self.tracedCheck(roomId, force)
+        finally:
+            self.checking.pop(roomId).set()
+
+    async def tracedCheck(self, roomId: int, force: bool):
+        trace = Trace()
+        token = currentTrace.set(trace)
+        outcome = "failed"
+        try:
+            run = await self.checkRoom(roomId, force, trace)
+            outcome = "skipped" if run is None else run.result.name.lower()
+        finally:
+            currentTrace.reset(token)
+            CHECK_LATENCY.observe(trace.elapsed() / 1000, outcome)
+            CHECKS.inc(outcome)
+            for name, elapsed in trace.phases.items():
+                PHASE_LATENCY.observe(elapsed / 1000, name)
+            self.leases.discard(roomId)
+            await self.manager.releaseLeases(self.instance, [roomId])
+
+    async def renewLease(self, roomId: int) -> bool:
+        with phase("lease"):
+            return await self.manager.holdLease(roomId, self.instance, datetime.now() + self.leaseTTL)
+
+    async def checkRoom(self, roomId: int, force: bool, trace: Trace) -> Optional[AntifreezeRun]:
         logger = self.logger.getChild(str(roomId))
         logger.info(f"Checking {roomId}")
         async with self.manager.db.session() as session:
-            roomDetails = await self.manager.getRoom(roomId)
-            assert roomDetails is not None
+            with phase("load"):
+                roomDetails = await self.manager.getRoom(roomId)
+            if roomDetails is None:
+                logger.info("Room no longer exists. Skipping.")
+                return
+            # the metadata has its own due time, and the room's next run is whichever comes first
+            lastChecked = datetime.now()
+            update = {}
+            refreshed = roomDetails.metadataRefreshedAt
+            metadataDue = lastChecked if refreshed is None else refreshed + self.metadataInterval
+            if force or metadataDue <= lastChecked:
+                try:
+                    update |= await self.refreshMetadata(roomDetails)
+                    metadataDue = lastChecked + self.metadataInterval
+                except Throttled:
+                    raise
+                except Exception:
+                    # not worth holding up the check for; try again with the next one
+                    logger.exception("Refreshing metadata failed")
+                    metadataDue = lastChecked + self.checkInterval
             if not roomDetails.active:
                 logger.info("Room is not active. Skipping.")
+                await self.manager.updateRoom(roomId, nextRunAt=min(lastChecked + self.checkInterval, metadataDue), **update)
                 return
-            lastChecked = datetime.now()
+            if not force and roomDetails.freezesAt is not None and lastChecked < roomDetails.freezesAt:
+                # nothing can have changed that would make it freeze any sooner
+                logger.info(f"Room cannot freeze before {roomDetails.freezesAt}. Skipping.")
+                await self.manager.updateRoom(roomId, nextRunAt=min(roomDetails.freezesAt, metadataDue), **update)
+                return
+            errors = 0
             try:
                 lastMessage = await self.lastMessageInRoom(roomDetails.roomId)
             except OperationFailedError as error:
                 logger.warning(f"An error occured! {error.args}")
                 message = error.args[1]
                 run = AntifreezeRun(
+                    roomId=roomId,
                     result=AntifreezeResult.ERROR,
                     ranAt=lastChecked,
                     mostRecentMessage=None,
                     error=message,
                 )
-                roomDetails.pendingErrors += 1
+                errors = 1
             else:
-                details = await self.getRoomDetails(roomId, roomDetails.server)
-                roomDetails.name = details.name
-                roomDetails.owners = [i async for i in self.getOwnersOfRoom(roomId, roomDetails.server)]
                 logger.info(
                     f"Last sent message was at {lastMessage.strftime('%e %b %Y %H:%M:%S%p')}, which was {(lastChecked - lastMessage).days} days ago"
                 )
@@ -119,36 +428,58 @@ class Antifreezer:
                     self.config["THRESHOLD"]
                 ):
                     logger.info("Not antifreezing, below threshold.")
+                    update["freezesAt"] = lastMessage + timedelta(days=int(self.config["THRESHOLD"]))
                     run = AntifreezeRun(
+                        roomId=roomId,
                         result=AntifreezeResult.OK,
                         ranAt=lastChecked,
                         mostRecentMessage=lastMessage,
                         error=None,
                     )
+                elif not await self.renewLease(roomId):
+                    # we stalled for long enough that another instance took over, so leave the sending to it
+                    logger.warning("Lost the lease on this room. Skipping.")
+                    return
                 else:
                     self.logger.info("Antifreezing room!")
-                    async with await Room.join(self.credentials, roomDetails.roomId) as room:
-                        try:
-                            await room.send(roomDetails.message.format(days=delta.days))
-                        except OperationFailedError as error:
-                            logger.warning(f"An error occured! {error.args}")
-                            message = error.args[0]
-                            run = AntifreezeRun(
-                                result=AntifreezeResult.ERROR,
-                                ranAt=lastChecked,
-                                mostRecentMessage=None,
-                                error=message,
-                            )
-                            roomDetails.pendingErrors += 1
-                        else:
-                            run = AntifreezeRun(
-                                result=AntifreezeResult.ANTIFREEZED,
-                                ranAt=lastChecked,
-                                mostRecentMessage=lastMessage,
-                                error=None,
-                            )
-        roomDetails.runs.insert(0, run)
-        if len(roomDetails.runs) > 32:
-            roomDetails.runs = roomDetails.runs[:32]
-        await self.manager.saveRoom(roomDetails)
-        self.logger.info("Antifreeze completed.")
+                    try:
+                        await self.rooms.send(roomDetails.roomId, roomDetails.message.format(days=delta.days))
+                    except OperationFailedError as error:
+                        logger.warning(f"An error occured! {error.args}")
+                        message = error.args[0]
+                        run = AntifreezeRun(
+                            roomId=roomId,
+                            result=AntifreezeResult.ERROR,
+                            ranAt=lastChecked,
+                            mostRecentMessage=None,
+                            error=message,
+                        )
+                        errors = 1
+                    else:
+                        update["freezesAt"] = lastChecked + timedelta(days=int(self.config["THRESHOLD"]))
+                        run = AntifreezeRun(
+                            roomId=roomId,
+                            result=AntifreezeResult.ANTIFREEZED,
+                            ranAt=lastChecked,
+                            mostRecentMessage=lastMessage,
+                            error=None,
+                        )
+        update["lastChecked"] = run.ranAt
+        update["lastResult"] = run.result
+        if run.result == AntifreezeResult.ANTIFREEZED:
+            update["lastAntifreezed"] = run.ranAt
+        update["nextRunAt"] = min(
+            max(
+                lastChecked + self.checkInterval,
+                update.get("freezesAt", roomDetails.freezesAt) or lastChecked,
+            ),
+            metadataDue,
+        )
+        with phase("save"):
+            await self.manager.updateRoom(roomId, inc={"pendingErrors": errors}, **update)
+        # written last, so the trace it carries covers everything but itself
+        run.duration = trace.elapsed()
+        run.phases = dict(trace.phases)
+        await self.manager.addRun(run)
+        self.logger.info(f"Antifreeze completed in {run.duration:.0f}ms.")
+        return run
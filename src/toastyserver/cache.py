@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[K, tuple[V, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K) -> Optional[V]:
+        if (entry := self.entries.get(key)) is None:
+            self.misses += 1
+            return None
+        value, expires = entry
+        if monotonic() >= expires:
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None):
+        self.entries[key] = (value, monotonic() + (self.ttl if ttl is None else ttl))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def fetch(self, key: K, fetcher: Callable[[], Awaitable[V]]) -> V:
+        if (value := self.get(key)) is None:
+            self.set(key, value := await fetcher())
+        return value
+
+    def invalidate(self, key: K):
+        self.entries.pop(key, None)
+
+    def invalidateWhere(self, predicate: Callable[[K, V], bool]):
+        for key in [key for key, (value, _) in self.entries.items() if predicate(key, value)]:
+            del self.entries[key]
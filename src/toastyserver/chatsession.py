@@ -0,0 +1,63 @@
+from asyncio import Lock
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Optional
+
+from aiohttp import ClientSession
+from sechat import Credentials
+from sechat.errors import OperationFailedError
+
+from toastyserver.ratelimit import RateLimiter
+from toastyserver.metrics import OUTBOUND_LATENCY, endpointOf, phase
+
+
+class ChatSession:
+    # Keeps one logged-in chat session open per credentials (and so per server), along with its fkey
+    def __init__(self, credentials: Credentials, limiter: RateLimiter, fkeyTTL: timedelta):
+        self.credentials = credentials
+        self.limiter = limiter
+        self.fkeyTTL = fkeyTTL
+        self.stack = AsyncExitStack()
+        self.lock = Lock()
+        self.session: Optional[ClientSession] = None
+        self.cachedFkey: Optional[tuple[str, datetime]] = None
+
+    async def getSession(self) -> ClientSession:
+        async with self.lock:
+            if self.session is None or self.session.closed:
+                self.session = await self.stack.enter_async_context(self.credentials.session())
+            return self.session
+
+    async def fkey(self, refresh: bool = False) -> str:
+        session = await self.getSession()
+        async with self.lock:
+            if not refresh and self.cachedFkey is not None:
+                fkey, fetched = self.cachedFkey
+                if datetime.now() - fetched < self.fkeyTTL:
+                    return fkey
+            fkey = await Credentials.scrape_fkey(session, self.credentials.server)
+            self.cachedFkey = (fkey, datetime.now())
+            return fkey
+
+    async def post(self, path: str, data: dict) -> dict:
+        session = await self.getSession()
+        for attempt in range(2):
+            with phase("fkey"):
+                fkey = await self.fkey(refresh=attempt > 0)
+            with phase(endpointOf(path)):
+                await self.limiter.acquire(self.credentials.server)
+                started = perf_counter()
+                async with session.post(path, data=data | {"fkey": fkey}) as response:
+                    OUTBOUND_LATENCY.observe(perf_counter() - started, endpointOf(path), str(response.status))
+                    await self.limiter.check(response)
+                    # a stale fkey or an expired login gets us a 4xx or an HTML page instead of JSON
+                    if response.status not in (401, 403) and response.content_type == "application/json":
+                        return await response.json()
+                    status = response.status
+        raise OperationFailedError(status, f"Chat rejected our credentials (HTTP {status})")
+
+    async def close(self):
+        await self.stack.aclose()
+        self.session = None
+        self.cachedFkey = None
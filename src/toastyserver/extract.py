@@ -0,0 +1,42 @@
+from typing import Optional
+
+from lxml import etree
+
+# Only one card container is needed out of pages that are mostly transcript and sidebar, so feed the page
+# through lxml's pull parser and stop as soon as that container has been closed, then XPath over just it.
+CHUNK = 16 * 1024
+
+
+def hasClass(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+OWNER_IDS = etree.XPath(f".//*[{hasClass('usercard')}]/@id")
+ROOM_CARDS = etree.XPath(f".//*[{hasClass('roomcard')} and not({hasClass('frozen')})]")
+ROOM_NAME = etree.XPath(f"(.//span[{hasClass('room-name')}])[1]/@title")
+
+
+def section(page: bytes, ident: str) -> Optional[etree._Element]:
+    parser = etree.HTMLPullParser(events=("end",), remove_comments=True, remove_pis=True, no_network=True)
+    for start in range(0, len(page), CHUNK):
+        parser.feed(page[start:start + CHUNK])
+        for _, element in parser.read_events():
+            if element.get("id") == ident:
+                return element
+    parser.close()
+    return None
+
+
+def roomOwners(page: bytes) -> list[int]:
+    assert (cards := section(page, "room-ownercards")) is not None
+    return [int(ident.removeprefix("owner-user-")) for ident in OWNER_IDS(cards)]
+
+
+def ownedRooms(page: bytes) -> list[tuple[int, str]]:
+    if (cards := section(page, "user-owningcards")) is None:
+        return []
+    rooms = []
+    for card in ROOM_CARDS(cards):
+        assert len(name := ROOM_NAME(card))
+        rooms.append((int(card.attrib["id"].removeprefix("room-")), str(name[0])))
+    return rooms
@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+from typing import Optional
+from hashlib import sha256
+from time import perf_counter
+
+from aiohttp import (
+    ClientSession,
+    TCPConnector,
+    DummyCookieJar,
+    TraceConfig,
+    TraceRequestStartParams,
+    TraceRequestEndParams,
+    TraceRequestExceptionParams,
+)
+from flask import Config
+
+from toastyserver.ratelimit import RateLimiter, originOf
+from toastyserver.models import FetchValidators
+from toastyserver.metrics import OUTBOUND_LATENCY, endpointOf
+
+
+class HttpPool:
+    def __init__(self, config: Config, limiter: RateLimiter):
+        self.config = config
+        self.limiter = limiter
+        self.sessions: dict[tuple[str, bool], ClientSession] = {}
+        self.trace = TraceConfig()
+        self.trace.on_request_start.append(self.onRequestStart)
+        self.trace.on_request_end.append(self.onRequestEnd)
+        self.trace.on_request_exception.append(self.onRequestException)
+        self.throttle = TraceConfig()
+        self.throttle.on_request_start.append(self.onThrottledRequestStart)
+
+    async def onThrottledRequestStart(
+        self, session: ClientSession, context: SimpleNamespace, params: TraceRequestStartParams
+    ):
+        await self.limiter.acquire(str(params.url))
+
+    async def onRequestStart(self, session: ClientSession, context: SimpleNamespace, params: TraceRequestStartParams):
+        # runs after the limiter, so the histogram shows SE's latency rather than our own throttling
+        context.started = perf_counter()
+
+    async def onRequestEnd(self, session: ClientSession, context: SimpleNamespace, params: TraceRequestEndParams):
+        OUTBOUND_LATENCY.observe(perf_counter() - context.started, endpointOf(params.url.path), str(params.response.status))
+
+    async def onRequestException(
+        self, session: ClientSession, context: SimpleNamespace, params: TraceRequestExceptionParams
+    ):
+        OUTBOUND_LATENCY.observe(perf_counter() - context.started, endpointOf(params.url.path), "error")
+
+    def session(self, url: str, throttled: bool = False) -> ClientSession:
+        # one keep-alive connection pool per server, created lazily so it is bound to the serving loop. background
+        # work goes through a throttled one, so backing off from SE never holds up someone's page load
+        key = (originOf(url), throttled)
+        if (session := self.sessions.get(key)) is None or session.closed:
+            session = self.sessions[key] = ClientSession(
+                connector=TCPConnector(
+                    limit=int(self.config.get("HTTP_CONNECTION_LIMIT", 100)),
+                    limit_per_host=int(self.config.get("HTTP_HOST_CONNECTION_LIMIT", 16)),
+                    ttl_dns_cache=int(self.config.get("HTTP_DNS_CACHE_TTL", 300)),
+                    keepalive_timeout=float(self.config.get("HTTP_KEEPALIVE_TIMEOUT", 30)),
+                ),
+                # shared between users, so never remember anyone's cookies
+                cookie_jar=DummyCookieJar(),
+                trace_configs=[self.throttle, self.trace] if throttled else [self.trace],
+                raise_for_status=self.limiter.check if throttled else False,
+            )
+        return session
+
+    async def fetchIfChanged(self, url: str, validators: FetchValidators) -> tuple[Optional[bytes], FetchValidators]:
+        # returns no body when the page is the same as when the validators were taken
+        headers = {}
+        if validators.etag is not None:
+            headers["If-None-Match"] = validators.etag
+        if validators.lastModified is not None:
+            headers["If-Modified-Since"] = validators.lastModified
+        async with self.session(url, throttled=True).get(url, headers=headers) as response:
+            if response.status == 304:
+                return None, validators
+            body = await response.read()
+            fresh = FetchValidators(
+                etag=response.headers.get("ETag"),
+                lastModified=response.headers.get("Last-Modified"),
+                digest=sha256(body).hexdigest(),
+            )
+        # chat doesn't always send validators, so fall back to comparing what came back
+        if validators.digest == fresh.digest:
+            return None, fresh
+        return body, fresh
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from flask import Config
+from logging import Logger
+
+from toastyserver.roommanager import RoomManager
+from toastyserver.jobmanager import JobManager
+from toastyserver.models import AntifreezeRoom, ImportResult, JobKind, Server, User
+
+
+class RoomImporter:
+    # only touches the database, so web workers can import rooms without logging the bot in
+    def __init__(self, config: Config, manager: RoomManager, jobs: JobManager, logger: Logger):
+        self.config = config
+        self.manager = manager
+        self.jobs = jobs
+        self.logger = logger
+
+    async def importRooms(
+        self, roomIds: list[int], server: Server, user: User, message: str, active: bool, locked: bool
+    ) -> list[ImportResult]:
+        results = {roomId: ImportResult(roomId) for roomId in roomIds}
+        for roomId in await self.manager.existingRoomIds(list(results)):
+            results[roomId].error = "Already added"
+        queued = [result for result in results.values() if result.error is None]
+        for result in queued:
+            # filled in by the import job
+            result.name = f"Room #{result.roomId}"
+        # stagger the first checks across the sweep window instead of running them all now
+        now = datetime.now()
+        window = timedelta(seconds=int(self.config.get("SWEEP_WINDOW", 60 * 60)))
+        rooms = [
+            AntifreezeRoom( # type: ignore
+                roomId=result.roomId,
+                server=server,
+                name=result.name,
+                active=active,
+                locked=locked,
+                addedBy=user.ident,
+                message=message,
+                nextRunAt=now + window * (index + 1) / len(queued),
+            )
+            for index, result in enumerate(queued)
+        ]
+        for roomId in await self.manager.insertRooms(rooms):
+            results[roomId].error = "Already added"
+        added = [result.roomId for result in queued if result.error is None]
+        # details and announcements go through the throttled chat session, so they don't hold up the moderator
+        await self.jobs.enqueueMany(JobKind.IMPORT, added)
+        self.logger.info(f"Imported {len(added)} of {len(results)} rooms for {user.name}")
+        return list(results.values())
@@ -0,0 +1,57 @@
+from datetime import timedelta
+from logging import Logger
+
+from odmantic import AIOEngine, Model
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from toastyserver.models import AntifreezeRoom, AntifreezeRun, Job, Site, Token, User
+
+MODELS: list[type[Model]] = [AntifreezeRoom, AntifreezeRun, Job, Site, Token, User]
+
+
+def declaredIndexes(model: type[Model]) -> dict[str, dict]:
+    indexes = {"_id_": {"_id": 1}}
+    for index in model.__indexes__():
+        document = (index if isinstance(index, IndexModel) else index.get_pymongo_index()).document
+        indexes[document["name"]] = dict(document["key"])
+    if model is AntifreezeRun:
+        indexes[f"{+AntifreezeRun.ranAt}_1"] = {+AntifreezeRun.ranAt: 1}
+    return indexes
+
+
+async def ensureIndexes(db: AIOEngine, runRetention: timedelta, logger: Logger):
+    # indexes whose definition changed get rebuilt rather than failing startup
+    await db.configure_database(MODELS, update_existing_indexes=True)
+    runs = db.get_collection(AntifreezeRun)
+    expiry = int(runRetention.total_seconds())
+    try:
+        await runs.create_index(+AntifreezeRun.ranAt, expireAfterSeconds=expiry)
+    except OperationFailure:
+        # the retention period changed since the index was made
+        await db.database.command(
+            "collMod", runs.name,
+            index={"keyPattern": {+AntifreezeRun.ranAt: 1}, "expireAfterSeconds": expiry},
+        )
+    for model in MODELS:
+        if not (existing := await db.get_collection(model).index_information()):
+            # the collection hasn't been created yet
+            continue
+        for name in declaredIndexes(model).keys() - existing.keys():
+            logger.warning(f"Index {name} is missing on {model.__collection__}")
+
+
+async def indexReport(db: AIOEngine) -> list[str]:
+    lines = []
+    for model in MODELS:
+        collection = db.get_collection(model)
+        declared = declaredIndexes(model)
+        stats = {stat["name"]: stat async for stat in collection.aggregate([{"$indexStats": {}}])}
+        for name in declared.keys() - stats.keys():
+            lines.append(f"{collection.name}: missing {name} {declared[name]}")
+        for name, stat in sorted(stats.items()):
+            if name not in declared:
+                lines.append(f"{collection.name}: undeclared {name} {dict(stat['key'])}")
+            if stat["accesses"]["ops"] == 0:
+                lines.append(f"{collection.name}: unused {name} since {stat['accesses']['since']:%e %b %Y %H:%M:%S}")
+    return lines
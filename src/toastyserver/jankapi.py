@@ -1,7 +1,5 @@
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup, Tag
-from aiohttp import ClientSession, CookieJar
 from quart import Blueprint, abort, request
 from sechat import Server
 
@@ -12,41 +10,47 @@ from toastyserver.models import (
 )
 from toastyserver.usermanager import UserManager
 from toastyserver.roommanager import RoomManager
+from toastyserver.httppool import HttpPool
+from toastyserver.cache import TTLCache
+from toastyserver.ratelimit import originOf
+from toastyserver.extract import ownedRooms
 
 
 class JankApi:
-    def __init__(self, usermanager: UserManager, roommanager: RoomManager):
+    def __init__(self, usermanager: UserManager, roommanager: RoomManager, http: HttpPool, cache: TTLCache):
         self.usermanager = usermanager
         self.roommanager = roommanager
+        self.http = http
+        self.cache = cache
         self.blueprint = Blueprint("jankapi", __name__, url_prefix="/jankapi")
         self.blueprint.route("/ownedrooms", methods=["POST"])(
             self.usermanager.requireUser(Role.USER)(self.userOwnedRoomsEndpoint)
         )
 
+    async def scrapeUserOwnedRooms(self, user: User, server: str) -> list[tuple[int, str]]:
+        async with self.http.session(server).get(
+            urljoin(server, f"/account/{user.ident}")
+        ) as response:
+            return ownedRooms(await response.read())
+
     async def getUserOwnedRooms(
         self, user: User, server: str, excludeExisting: bool = True
     ):
         addedRooms = [
-            room.roomId async for room in self.roommanager.getRoomsOfUser(user)
-        ]
-        async with ClientSession() as session:
-            async with session.get(
-                urljoin(server, f"/account/{user.ident}")
-            ) as response:
-                soup = BeautifulSoup(await response.read(), features="lxml")
-        assert isinstance(cards := soup.find(id="user-owningcards"), Tag | None)
-        if cards is None:
-            return
-        for tag in cards.find_all(class_="roomcard"):
-            if not isinstance(tag, Tag):
-                continue
-            if "frozen" in tag.get_attribute_list("class"):
-                continue
-            assert isinstance(name := tag.find("span", class_="room-name"), Tag)
-            ident = int(tag.attrs["id"].removeprefix("room-"))
+            room.roomId async for room in self.roommanager.getRoomSummariesOfUser(user)
+        ] if excludeExisting else []
+        for ident, name in await self.cache.fetch(
+            ("ownedRooms", originOf(server), user.ident), lambda: self.scrapeUserOwnedRooms(user, server)
+        ):
             if (ident in addedRooms) and excludeExisting:
                 continue
-            yield ident, name.attrs["title"]
+            yield ident, name
+
+    def invalidateRoom(self, roomId: int, server: str):
+        server = originOf(server)
+        self.cache.invalidateWhere(
+            lambda key, value: key[:2] == ("ownedRooms", server) and any(ident == roomId for ident, _ in value)
+        )
 
     async def userOwnedRoomsEndpoint(self, user: User):
         server = Server((await request.json)["server"])
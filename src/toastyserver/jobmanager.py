@@ -0,0 +1,64 @@
+from typing import Optional
+from datetime import datetime
+
+from odmantic import AIOEngine
+from odmantic.query import desc
+from pymongo import ReturnDocument
+
+from toastyserver.models import Job, JobKind, JobState
+from toastyserver.metrics import instrumented
+
+
+@instrumented
+class JobManager:
+    def __init__(self, db: AIOEngine):
+        self.db = db
+
+    async def enqueue(self, kind: JobKind, roomId: int, at: Optional[datetime] = None) -> Job:
+        now = datetime.now()
+        job = Job(kind=kind, roomId=roomId, created=now, runAt=at or now)
+        await self.db.save(job)
+        return job
+
+    async def enqueueMany(self, kind: JobKind, roomIds: list[int]):
+        if not len(roomIds):
+            return
+        now = datetime.now()
+        await self.db.get_collection(Job).insert_many(
+            [Job(kind=kind, roomId=roomId, created=now, runAt=now).model_dump_doc() for roomId in roomIds]
+        )
+
+    async def claim(self, now: datetime, staleBefore: datetime) -> Optional[Job]:
+        # jobs whose worker died mid-run are picked up again once their claim has gone stale
+        doc = await self.db.get_collection(Job).find_one_and_update(
+            {"$or": [
+                {+Job.state: JobState.PENDING.value, +Job.runAt: {"$lte": now}},
+                {+Job.state: JobState.RUNNING.value, +Job.claimedAt: {"$lte": staleBefore}},
+            ]},
+            {"$set": {+Job.state: JobState.RUNNING.value, +Job.claimedAt: now}, "$inc": {+Job.attempts: 1}},
+            sort=[(+Job.runAt, 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return None if doc is None else Job.model_validate_doc(doc)
+
+    async def countDue(self, now: datetime) -> int:
+        return await self.db.get_collection(Job).count_documents(
+            {+Job.state: JobState.PENDING.value, +Job.runAt: {"$lte": now}}
+        )
+
+    async def markStep(self, job: Job, step: str):
+        job.steps.append(step)
+        await self.db.get_collection(Job).update_one({"_id": job.id}, {"$addToSet": {+Job.steps: step}})
+
+    async def finish(self, job: Job, state: JobState, error: Optional[str] = None):
+        await self.db.get_collection(Job).update_one({"_id": job.id}, {"$set": {
+            +Job.state: state.value, +Job.finished: datetime.now(), +Job.error: error,
+        }})
+
+    async def retry(self, job: Job, error: str, at: datetime):
+        await self.db.get_collection(Job).update_one({"_id": job.id}, {"$set": {
+            +Job.state: JobState.PENDING.value, +Job.runAt: at, +Job.claimedAt: None, +Job.error: error,
+        }})
+
+    async def latestForRoom(self, roomId: int) -> Optional[Job]:
+        return await self.db.find_one(Job, Job.roomId == roomId, sort=desc(Job.created))
@@ -0,0 +1,84 @@
+from asyncio import CancelledError, Task, create_task, gather, sleep
+from datetime import datetime, timedelta
+from typing import Optional
+from logging import Logger
+
+from sechat import Credentials, Room
+from sechat.events import MessageEvent
+
+from toastyserver.roommanager import RoomManager
+from toastyserver.ratelimit import RateLimiter
+
+
+class ActivityListener:
+    def __init__(self, credentials: Credentials, manager: RoomManager, limiter: RateLimiter, logger: Logger):
+        self.credentials = credentials
+        self.manager = manager
+        self.limiter = limiter
+        self.logger = logger
+        self.subscriptions: dict[int, Task] = {}
+        self.live: set[int] = set()
+        # only trustworthy while the room's subscription has stayed up since the value was learned
+        self.activity: dict[int, datetime] = {}
+        self.written: dict[int, datetime] = {}
+
+    async def sync(self):
+        # rooms are added, paused and deleted by web workers that may live in other processes
+        active = set(await self.manager.activeRoomIds())
+        for roomId in active - self.subscriptions.keys():
+            self.subscribe(roomId)
+        for roomId in self.subscriptions.keys() - active:
+            self.unsubscribe(roomId)
+
+    async def shutdown(self):
+        tasks = list(self.subscriptions.values())
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+        self.subscriptions.clear()
+
+    def subscribe(self, roomId: int):
+        if roomId not in self.subscriptions:
+            self.subscriptions[roomId] = create_task(self.listen(roomId))
+
+    def unsubscribe(self, roomId: int):
+        if (task := self.subscriptions.pop(roomId, None)) is not None:
+            task.cancel()
+        self.written.pop(roomId, None)
+
+    def lastActivity(self, roomId: int) -> Optional[datetime]:
+        if roomId not in self.live:
+            return None
+        return self.activity.get(roomId)
+
+    def seed(self, roomId: int, lastMessage: datetime):
+        # called with a polled value, so later events only have to move it forwards
+        if roomId in self.live:
+            self.activity[roomId] = max(lastMessage, self.activity.get(roomId, lastMessage))
+
+    async def record(self, roomId: int, at: datetime):
+        self.activity[roomId] = max(at, self.activity.get(roomId, at))
+        if (written := self.written.get(roomId)) is not None and at - written < timedelta(minutes=1):
+            return
+        self.written[roomId] = at
+        await self.manager.recordActivity(roomId, at)
+
+    async def listen(self, roomId: int):
+        logger = self.logger.getChild(str(roomId))
+        while True:
+            try:
+                await self.limiter.acquire(self.credentials.server)
+                async with await Room.join(self.credentials, roomId) as room:
+                    self.live.add(roomId)
+                    logger.debug("Subscribed")
+                    async for event in room.events():
+                        if isinstance(event, MessageEvent) and event.user_id > 0:
+                            await self.record(roomId, datetime.fromtimestamp(event.time_stamp))
+            except CancelledError:
+                raise
+            except Exception:
+                logger.exception("Subscription failed")
+            finally:
+                self.live.discard(roomId)
+                self.activity.pop(roomId, None)
+            await sleep(60)
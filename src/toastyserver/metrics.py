@@ -0,0 +1,297 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from inspect import isasyncgenfunction, isawaitable, iscoroutinefunction, isfunction
+from math import ceil
+from time import perf_counter
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Optional, Union
+
+# A minimal Prometheus text-format registry. Recording is a dict lookup and an addition, so it stays on in
+# production; everything else happens when /metrics is scraped.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+Labels = tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[str]:
+        return []
+
+    async def read(self) -> list[str]:
+        return list(self.samples())
+
+    async def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *await self.read()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{formatLabels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Labels = (), buckets: tuple[float, ...] = BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label set: a count for each bucket (plus +Inf), then the sum
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        if (entry := self.values.get(labels)) is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{formatLabels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{formatLabels(self.labels, labels)} {total[0]}"
+            yield f"{self.name}_count{formatLabels(self.labels, labels)} {cumulative}"
+
+
+Source = Callable[[], Union[Iterable[tuple[Labels, float]], Awaitable[Iterable[tuple[Labels, float]]]]]
+
+
+class Collected(Metric):
+    # read off live objects, or counted in the database, at scrape time
+    def __init__(self, name: str, help: str, kind: str, labels: Labels = ()):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.sources: list[Source] = []
+
+    def collect(self, source: Source):
+        self.sources.append(source)
+
+    async def read(self) -> list[str]:
+        samples = []
+        for source in self.sources:
+            if isawaitable(values := source()):
+                values = await values
+            samples.extend(f"{self.name}{formatLabels(self.labels, labels)} {value}" for labels, value in values)
+        return samples
+
+
+REGISTRY: list[Metric] = []
+
+OUTBOUND_LATENCY = Histogram(
+    "toasty_outbound_request_seconds", "Latency of requests to Stack Exchange", ("endpoint", "status")
+)
+DATABASE_LATENCY = Histogram("toasty_database_operation_seconds", "Latency of database operations", ("operation",))
+ROUTE_LATENCY = Histogram("toasty_route_seconds", "Time taken to handle a request", ("route", "method", "status"))
+CHECK_LATENCY = Histogram("toasty_check_seconds", "Time taken to check a room", ("result",))
+CHECKS = Counter("toasty_checks_total", "Rooms checked, by result", ("result",))
+PHASE_LATENCY = Histogram("toasty_check_phase_seconds", "Time spent in each phase of a room check", ("phase",))
+JOIN_LATENCY = Histogram("toasty_chat_join_seconds", "Time taken to join a chat room")
+JOBS = Counter("toasty_jobs_total", "Background jobs run, by kind and outcome", ("kind", "outcome"))
+QUEUE_DEPTH = Collected("toasty_queue_depth", "Work waiting, in the database and in memory", "gauge", ("queue",))
+CACHE_HITS = Collected("toasty_cache_hits_total", "Cache hits", "counter", ("cache",))
+CACHE_MISSES = Collected("toasty_cache_misses_total", "Cache misses", "counter", ("cache",))
+POOL_SIZE = Collected("toasty_pool_size", "Open pooled connections", "gauge", ("pool",))
+# joins are counted by JOIN_LATENCY, so together these give the pool's hit rate
+POOL_REUSES = Counter("toasty_pool_reuses_total", "Uses of a chat room that was already joined")
+
+ENDPOINTS = [
+    ("/events", "events"),
+    ("/rooms/thumbs/", "thumbs"),
+    ("/rooms/info/", "info"),
+    ("/account/", "account"),
+    ("/users/", "account"),
+    ("/messages/", "send"),
+    ("/2.3/sites", "sites"),
+    ("/2.3/me", "me"),
+    ("/oauth/", "oauth"),
+]
+
+
+def endpointOf(path: str) -> str:
+    for fragment, endpoint in ENDPOINTS:
+        if fragment in path:
+            return endpoint
+    return "other"
+
+
+def cacheStats(name: str, cache):
+    CACHE_HITS.collect(lambda: [((name,), cache.hits)])
+    CACHE_MISSES.collect(lambda: [((name,), cache.misses)])
+
+
+def instrumented(cls):
+    # times every public method of a manager under its qualified name, including the listings they hand back
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or getattr(method, "untimed", False):
+            continue
+        if isasyncgenfunction(method):
+            setattr(cls, name, timedGenerator(method, f"{cls.__name__}.{name}"))
+        elif iscoroutinefunction(method):
+            setattr(cls, name, timedMethod(method, f"{cls.__name__}.{name}"))
+        elif isfunction(method):
+            setattr(cls, name, timedCursorMethod(method, f"{cls.__name__}.{name}"))
+    return cls
+
+
+def untimed(method: Callable):
+    # for methods that usually answer from memory; whatever they fall back to is timed on its own
+    method.untimed = True
+    return method
+
+
+def timedMethod(method: Callable, operation: str):
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+        except BaseException:
+            DATABASE_LATENCY.observe(perf_counter() - started, operation)
+            raise
+        if hasattr(result, "__aiter__"):
+            # the query runs when the cursor is read, not when it's handed back
+            return TimedCursor(result, operation)
+        DATABASE_LATENCY.observe(perf_counter() - started, operation)
+        return result
+    return wrapper
+
+
+def timedCursorMethod(method: Callable, operation: str):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        result = method(*args, **kwargs)
+        return TimedCursor(result, operation) if hasattr(result, "__aiter__") else result
+    return wrapper
+
+
+def timedGenerator(method: Callable, operation: str):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        return timedIteration(method(*args, **kwargs), operation)
+    return wrapper
+
+
+async def timedIteration(iterable: AsyncIterable, operation: str):
+    # only the time spent fetching counts, not the time the caller spends on each item
+    iterator = aiter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            started = perf_counter()
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += perf_counter() - started
+            yield item
+    finally:
+        DATABASE_LATENCY.observe(elapsed, operation)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class TimedCursor:
+    def __init__(self, cursor, operation: str):
+        self.cursor = cursor
+        self.operation = operation
+
+    def __await__(self):
+        return self.fetchAll().__await__()
+
+    async def fetchAll(self):
+        started = perf_counter()
+        try:
+            return await self.cursor
+        finally:
+            DATABASE_LATENCY.observe(perf_counter() - started, self.operation)
+
+    def __aiter__(self):
+        return timedIteration(self.cursor, self.operation)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+async def render() -> str:
+    return "\n".join([await metric.render() for metric in REGISTRY]) + "\n"
+
+
+@dataclass
+class Trace:
+    # milliseconds spent in each phase of one room check, kept with its run
+    started: float = field(default_factory=perf_counter)
+    phases: dict[str, float] = field(default_factory=dict)
+
+    def elapsed(self) -> float:
+        return (perf_counter() - self.started) * 1000
+
+
+currentTrace: ContextVar[Optional[Trace]] = ContextVar("currentTrace", default=None)
+
+
+@contextmanager
+def phase(name: str):
+    # only costs anything inside a traced check; phases with the same name add up
+    if (trace := currentTrace.get()) is None:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        trace.phases[name] = trace.phases.get(name, 0) + (perf_counter() - started) * 1000
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def phasePercentiles(timings: Iterable[tuple[Optional[float], dict[str, float]]]) -> dict[str, list[float]]:
+    # nearest-rank percentiles of each phase over the runs that went through it, then of the whole run
+    samples: dict[str, list[float]] = {}
+    totals = []
+    for duration, phases in timings:
+        if duration is None:
+            # from before runs were traced
+            continue
+        totals.append(duration)
+        for name, value in phases.items():
+            samples.setdefault(name, []).append(value)
+    if len(totals):
+        samples["total"] = totals
+    return {
+        name: [values[max(0, ceil(point / 100 * len(values)) - 1)] for point in PERCENTILES]
+        for name, values in ((name, sorted(values)) for name, values in samples.items())
+    }
@@ -4,8 +4,10 @@ from enum import IntEnum
 from dataclasses import dataclass
 from sechat import Server
 
-from odmantic import Model, EmbeddedModel, Field, Reference
-from pydantic import BaseModel, Field as PDField
+from odmantic import Model, EmbeddedModel, Field, Reference, Index
+from odmantic.query import desc
+from pymongo import IndexModel
+from pydantic import BaseModel, Field as PDField, field_validator
 
 DEFAULTMSG = "Toasty Antifreeze triggered! Last message was sent {days} days ago."
 
@@ -31,6 +33,17 @@ class Token(Model):
     expiry: datetime
     user: User = Reference()
 
+    model_config = {
+        # let mongo throw away tokens nobody came back with
+        "indexes": lambda: [IndexModel(+Token.expiry, expireAfterSeconds=0)]
+    }
+
+
+class Site(Model):
+    url: str = Field(primary_field=True)
+    apiSiteParameter: str
+    refreshed: datetime
+
 
 class AntifreezeResult(IntEnum):
     OK = 0
@@ -38,11 +51,25 @@ class AntifreezeResult(IntEnum):
     ERROR = 2
 
 
-class AntifreezeRun(EmbeddedModel):
+class AntifreezeRun(Model):
+    roomId: int
     result: AntifreezeResult
     ranAt: datetime
     mostRecentMessage: Optional[datetime]
     error: Optional[str]
+    # milliseconds, for the whole check and per phase of it
+    duration: Optional[float] = None
+    phases: dict[str, float] = Field(default_factory=dict)
+
+    model_config = {
+        "indexes": lambda: [Index(AntifreezeRun.roomId, desc(AntifreezeRun.ranAt))]
+    }
+
+
+class FetchValidators(EmbeddedModel):
+    etag: Optional[str] = None
+    lastModified: Optional[str] = None
+    digest: Optional[str] = None
 
 
 class AntifreezeRoom(Model):
@@ -53,9 +80,59 @@ class AntifreezeRoom(Model):
     locked: bool = False
     pendingErrors: int = 0
     message: str = DEFAULTMSG
-    runs: list[AntifreezeRun] = []
-    owners: list[int] = []
-    addedBy: int  # Why isn't this a reference? Becase odmantic doesn't support querying across references for SOME REASON
+    lastChecked: Optional[datetime] = None
+    lastAntifreezed: Optional[datetime] = None
+    lastResult: Optional[AntifreezeResult] = None
+    owners: list[int] = Field(default=[], index=True)
+    addedBy: int = Field(index=True)  # Why isn't this a reference? Becase odmantic doesn't support querying across references for SOME REASON
+    nextRunAt: Optional[datetime] = Field(default=None, index=True)
+    freezesAt: Optional[datetime] = None
+    lastActivity: Optional[datetime] = None
+    metadataRefreshedAt: Optional[datetime] = None
+    thumbsValidators: FetchValidators = Field(default_factory=FetchValidators)
+    infoValidators: FetchValidators = Field(default_factory=FetchValidators)
+    leaseOwner: Optional[str] = None
+    leaseUntil: Optional[datetime] = None
+
+    model_config = {
+        "indexes": lambda: [Index(AntifreezeRoom.name, AntifreezeRoom.roomId)]
+    }
+
+
+class JobKind(IntEnum):
+    ONBOARD = 0
+    NOTIFY = 1
+    CHECK = 2
+    IMPORT = 3
+
+
+class JobState(IntEnum):
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+
+class Job(Model):
+    kind: JobKind
+    roomId: int
+    state: JobState = JobState.PENDING
+    attempts: int = 0
+    steps: list[str] = []
+    created: datetime
+    runAt: datetime
+    claimedAt: Optional[datetime] = None
+    finished: Optional[datetime] = None
+    error: Optional[str] = None
+
+    model_config = {
+        "indexes": lambda: [
+            Index(Job.state, Job.runAt),
+            Index(Job.roomId, desc(Job.created)),
+            # finished jobs are only kept around long enough to show how they went
+            IndexModel(+Job.finished, expireAfterSeconds=7 * 24 * 60 * 60),
+        ]
+    }
 
 
 # forms
@@ -74,14 +151,65 @@ class EditRoomForm(BaseModel):
     locked: bool = False
 
 
+class ImportRoomsForm(BaseModel):
+    server: Server
+    rooms: list[int]
+    message: str
+    active: bool = False
+    locked: bool = False
+
+    @field_validator("rooms", mode="before")
+    @classmethod
+    def splitRooms(cls, value):
+        # room ids come in as one blob of text, separated however they were pasted
+        if isinstance(value, str):
+            return value.replace(",", " ").split()
+        return value
+
+
 class EditUserForm(BaseModel):
     username: str
     role: Role
 
 
 # other stuff
+@dataclass(slots=True)
+class RoomSummary:
+    # just what the room lists show, read straight off a projected document
+    roomId: int
+    name: str
+    pendingErrors: int
+    locked: bool
+    addedBy: int
+
+    @classmethod
+    def fromDoc(cls, doc: dict) -> "RoomSummary":
+        return cls(
+            roomId=doc["_id"],
+            name=doc[+AntifreezeRoom.name],
+            pendingErrors=doc.get(+AntifreezeRoom.pendingErrors, 0),
+            locked=doc.get(+AntifreezeRoom.locked, False),
+            addedBy=doc[+AntifreezeRoom.addedBy],
+        )
+
+
+ROOM_SUMMARY_PROJECTION = {
+    +AntifreezeRoom.name: 1,
+    +AntifreezeRoom.pendingErrors: 1,
+    +AntifreezeRoom.locked: 1,
+    +AntifreezeRoom.addedBy: 1,
+}
+
+
 @dataclass
 class RoomDetails:
     ident: int
     name: str
     description: str
+
+
+@dataclass
+class ImportResult:
+    roomId: int
+    name: Optional[str] = None
+    error: Optional[str] = None
@@ -0,0 +1,82 @@
+from asyncio import sleep
+from time import monotonic
+from urllib.parse import urlsplit
+
+from aiohttp import ClientResponse
+from flask import Config
+
+
+def originOf(url: str) -> str:
+    return "{0.scheme}://{0.netloc}".format(urlsplit(url))
+
+
+class Throttled(Exception):
+    def __init__(self, server: str, retryAfter: float):
+        super().__init__(server, retryAfter)
+        self.server = server
+        self.retryAfter = retryAfter
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.baseRate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.pausedUntil = 0.0
+
+    async def acquire(self):
+        # nothing awaits between refilling and taking a token, so no lock is needed, and a caller waiting out a
+        # pause doesn't hold up the others' checks of it
+        while True:
+            now = monotonic()
+            if now < self.pausedUntil:
+                await sleep(self.pausedUntil - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await sleep((1 - self.tokens) / self.rate)
+
+    def backoff(self, seconds: float):
+        # halve the rate and stop handing out tokens until the server has cooled off
+        self.pausedUntil = max(self.pausedUntil, monotonic() + seconds)
+        self.rate = max(self.baseRate / 16, self.rate / 2)
+        self.tokens = 0
+
+    def recover(self):
+        self.rate = min(self.baseRate, self.rate + self.baseRate / 32)
+
+
+class RateLimiter:
+    def __init__(self, config: Config):
+        self.config = config
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def bucket(self, url: str) -> TokenBucket:
+        if (bucket := self.buckets.get(server := originOf(url))) is None:
+            bucket = self.buckets[server] = TokenBucket(
+                float(self.config.get("SWEEP_RATE", 2)),
+                float(self.config.get("SWEEP_BURST", 5)),
+            )
+        return bucket
+
+    async def acquire(self, url: str):
+        await self.bucket(url).acquire()
+
+    def pausedFor(self, url: str) -> float:
+        return max(0.0, self.bucket(url).pausedUntil - monotonic())
+
+    async def check(self, response: ClientResponse):
+        bucket = self.bucket(str(response.url))
+        if response.status in (429, 503):
+            try:
+                retryAfter = float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                retryAfter = float(self.config.get("SWEEP_BACKOFF", 60))
+            bucket.backoff(retryAfter)
+            raise Throttled(originOf(str(response.url)), retryAfter)
+        bucket.recover()
@@ -1,25 +1,249 @@
 from typing import Optional
+from datetime import datetime, timedelta
+from hashlib import sha1
 
-from odmantic import AIOEngine
+from odmantic import AIOEngine, ObjectId
+from odmantic.query import desc
 from odmantic.session import AIOSession
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
 
-from toastyserver.models import AntifreezeRoom, User
+from toastyserver.models import AntifreezeRoom, AntifreezeRun, AntifreezeResult, Job, User, RoomSummary, ROOM_SUMMARY_PROJECTION
+from toastyserver.metrics import instrumented
 
+def migratedRunId(roomId: int, ranAt: datetime) -> ObjectId:
+    # keeps the usual timestamp prefix, with the room and exact time standing in for the random part
+    return ObjectId(int(ranAt.timestamp()).to_bytes(4, "big") + sha1(f"{roomId}:{ranAt.isoformat()}".encode()).digest()[:8])
+
+
+@instrumented
 class RoomManager:
     def __init__(self, db: AIOEngine):
         self.db = db
 
+    async def migrateEmbeddedRuns(self):
+        # rooms used to carry their last 32 runs inline. once they've all been moved a marker is left, so
+        # startups after that don't have to scan every room to find out
+        migrations = self.db.database["migrations"]
+        if await migrations.find_one({"_id": "embeddedRuns"}) is not None:
+            return
+        rooms = self.db.get_collection(AntifreezeRoom)
+        # runs are copied before they're removed from the room, under ids derived from what they are, so a
+        # crash in between (or two processes starting up together) just copies the same runs again
+        while (doc := await rooms.find_one({"runs": {"$exists": True}}, {"runs": 1})) is not None:
+            runs = [AntifreezeRun(id=migratedRunId(doc["_id"], run["ranAt"]), roomId=doc["_id"], **run) for run in doc["runs"]]
+            if len(runs):
+                await self.db.get_collection(AntifreezeRun).bulk_write(
+                    [ReplaceOne({"_id": run.id}, run.model_dump_doc(), upsert=True) for run in runs], ordered=False
+                )
+            antifreezed = [run.ranAt for run in runs if run.result == AntifreezeResult.ANTIFREEZED]
+            await rooms.update_one({"_id": doc["_id"]}, {
+                "$unset": {"runs": ""},
+                "$set": {
+                    +AntifreezeRoom.lastChecked: runs[0].ranAt if len(runs) else None,
+                    +AntifreezeRoom.lastAntifreezed: max(antifreezed, default=None),
+                    +AntifreezeRoom.lastResult: runs[0].result.value if len(runs) else None,
+                },
+            })
+        await migrations.update_one({"_id": "embeddedRuns"}, {"$set": {"finished": datetime.now()}}, upsert=True)
+
     def allRooms(self, session: Optional[AIOSession] = None):
         return self.db.find(AntifreezeRoom)
 
+    @staticmethod
+    def pageFilter(after: Optional[tuple[str, int]]) -> dict:
+        # keyset over the (name, roomId) index, so later pages cost the same as the first
+        if after is None:
+            return {}
+        name, roomId = after
+        return {"$or": [
+            {+AntifreezeRoom.name: {"$gt": name}},
+            {+AntifreezeRoom.name: name, +AntifreezeRoom.roomId: {"$gt": roomId}},
+        ]}
+
+    async def allRoomSummariesWithUsers(self, after: Optional[tuple[str, int]] = None, limit: int = 0):
+        # join in each room's adder and sort on the server instead of looking users up one at a time
+        pipeline = [
+            {"$match": self.pageFilter(after)},
+            {"$sort": {+AntifreezeRoom.name: 1, +AntifreezeRoom.roomId: 1}},
+        ]
+        if limit:
+            pipeline.append({"$limit": limit})
+        async for doc in self.db.get_collection(AntifreezeRoom).aggregate([
+            *pipeline,
+            {"$project": ROOM_SUMMARY_PROJECTION},
+            {"$lookup": {
+                "from": self.db.get_collection(User).name,
+                "localField": +AntifreezeRoom.addedBy,
+                "foreignField": +User.ident,
+                "as": "addedByUser",
+            }},
+            {"$unwind": "$addedByUser"},
+        ]):
+            user = User.model_validate_doc(doc.pop("addedByUser"))
+            yield RoomSummary.fromDoc(doc), user
+
     async def getRoom(self, roomId: int, session: Optional[AIOSession] = None):
         return await self.db.find_one(AntifreezeRoom, AntifreezeRoom.roomId == roomId, session=session)
 
     async def deleteRoom(self, room: AntifreezeRoom, session: Optional[AIOSession] = None):
         await self.db.delete(room, session=session)
+        await self.db.get_collection(AntifreezeRun).delete_many({+AntifreezeRun.roomId: room.roomId})
+        await self.db.get_collection(Job).delete_many({+Job.roomId: room.roomId})
+
+    async def addRun(self, run: AntifreezeRun):
+        await self.db.get_collection(AntifreezeRun).insert_one(run.model_dump_doc())
+
+    def getRuns(self, roomId: int, limit: int = 32, session: Optional[AIOSession] = None):
+        return self.db.find(
+            AntifreezeRun, AntifreezeRun.roomId == roomId, sort=desc(AntifreezeRun.ranAt), limit=limit, session=session
+        )
+
+    def getSlowRuns(self, since: datetime, limit: int):
+        return self.db.find(
+            AntifreezeRun,
+            AntifreezeRun.ranAt >= since,
+            AntifreezeRun.duration != None,
+            sort=desc(AntifreezeRun.duration),
+            limit=limit,
+        )
+
+    async def getRunTimings(self, since: datetime) -> list[tuple[Optional[float], dict[str, float]]]:
+        cursor = self.db.get_collection(AntifreezeRun).find(
+            {+AntifreezeRun.ranAt: {"$gte": since}, +AntifreezeRun.duration: {"$ne": None}},
+            {+AntifreezeRun.duration: 1, +AntifreezeRun.phases: 1},
+        )
+        return [(doc[+AntifreezeRun.duration], doc.get(+AntifreezeRun.phases, {})) async for doc in cursor]
 
     async def saveRoom(self, room: AntifreezeRoom, session: Optional[AIOSession] = None):
         await self.db.save(room, session=session)
 
-    def getRoomsOfUser(self, user: User, session: Optional[AIOSession] = None):
-        return self.db.find(AntifreezeRoom, {"$or": [AntifreezeRoom.addedBy == user.ident, {+AntifreezeRoom.owners: user.chatIdent}]}, session=session) # type: ignore
\ No newline at end of file
+    async def existingRoomIds(self, roomIds: list[int]) -> set[int]:
+        return {
+            doc["_id"]
+            async for doc in self.db.get_collection(AntifreezeRoom).find({"_id": {"$in": roomIds}}, {"_id": 1})
+        }
+
+    async def insertRooms(self, rooms: list[AntifreezeRoom]) -> list[int]:
+        # returns the rooms that turned out to exist already
+        if not len(rooms):
+            return []
+        try:
+            await self.db.get_collection(AntifreezeRoom).insert_many(
+                [room.model_dump_doc() for room in rooms], ordered=False
+            )
+        except BulkWriteError as error:
+            if any(failure["code"] != 11000 for failure in error.details["writeErrors"]):
+                raise
+            return [rooms[failure["index"]].roomId for failure in error.details["writeErrors"]]
+        return []
+
+    async def updateRoom(self, roomId: int, inc: Optional[dict[str, int]] = None, **fields) -> bool:
+        # only touch the given fields, so concurrent writers don't clobber each other
+        update = {}
+        if len(fields):
+            update["$set"] = {+getattr(AntifreezeRoom, name): value for name, value in fields.items()}
+        if inc:
+            update["$inc"] = {+getattr(AntifreezeRoom, name): value for name, value in inc.items()}
+        result = await self.db.get_collection(AntifreezeRoom).update_one({+AntifreezeRoom.roomId: roomId}, update)
+        return result.matched_count > 0
+
+    async def getRoomSummariesOfUser(self, user: User, after: Optional[tuple[str, int]] = None, limit: int = 0):
+        async for doc in self.db.get_collection(AntifreezeRoom).find(
+            {"$and": [
+                {"$or": [{+AntifreezeRoom.addedBy: user.ident}, {+AntifreezeRoom.owners: user.chatIdent}]},
+                self.pageFilter(after),
+            ]},
+            ROOM_SUMMARY_PROJECTION,
+        ).sort([(+AntifreezeRoom.name, 1), (+AntifreezeRoom.roomId, 1)]).limit(limit):
+            yield RoomSummary.fromDoc(doc)
+
+    async def scheduleRoom(self, roomId: int, at: datetime):
+        await self.db.get_collection(AntifreezeRoom).update_one(
+            {+AntifreezeRoom.roomId: roomId}, {"$set": {+AntifreezeRoom.nextRunAt: at}}
+        )
+
+    async def scheduleUnscheduledRooms(self, now: datetime, window: timedelta):
+        # spread rooms that have never been scheduled randomly over the window, server-side
+        await self.db.get_collection(AntifreezeRoom).update_many(
+            {+AntifreezeRoom.nextRunAt: None},
+            [{"$set": {+AntifreezeRoom.nextRunAt: {"$add": [now, {"$multiply": [{"$rand": {}}, window.total_seconds() * 1000]}]}}}],
+        )
+
+    async def claimDueRooms(self, owner: str, now: datetime, until: datetime, retryAt: datetime, limit: int) -> list[int]:
+        # taken one at a time, so instances polling at the same moment can never both get a room. they're
+        # also pushed out to retryAt, so a check that fails before rescheduling its room is retried then
+        # instead of on the next poll
+        rooms = []
+        while len(rooms) < limit:
+            doc = await self.db.get_collection(AntifreezeRoom).find_one_and_update(
+                {
+                    +AntifreezeRoom.nextRunAt: {"$lte": now},
+                    "$or": [{+AntifreezeRoom.leaseUntil: None}, {+AntifreezeRoom.leaseUntil: {"$lt": now}}],
+                },
+                {
+                    "$set": {
+                        +AntifreezeRoom.leaseOwner: owner,
+                        +AntifreezeRoom.leaseUntil: until,
+                        +AntifreezeRoom.nextRunAt: retryAt,
+                    }
+                },
+                {"_id": 1},
+                sort=[(+AntifreezeRoom.nextRunAt, 1)],
+            )
+            if doc is None:
+                break
+            rooms.append(doc["_id"])
+        return rooms
+
+    async def countDueRooms(self, now: datetime) -> int:
+        return await self.db.get_collection(AntifreezeRoom).count_documents({+AntifreezeRoom.nextRunAt: {"$lte": now}})
+
+    async def acquireLease(self, roomId: int, owner: str, now: datetime, until: datetime) -> bool:
+        result = await self.db.get_collection(AntifreezeRoom).update_one(
+            {
+                +AntifreezeRoom.roomId: roomId,
+                "$or": [
+                    {+AntifreezeRoom.leaseOwner: owner},
+                    {+AntifreezeRoom.leaseUntil: None},
+                    {+AntifreezeRoom.leaseUntil: {"$lt": now}},
+                ],
+            },
+            {"$set": {+AntifreezeRoom.leaseOwner: owner, +AntifreezeRoom.leaseUntil: until}},
+        )
+        return result.matched_count > 0
+
+    async def holdLease(self, roomId: int, owner: str, until: datetime) -> bool:
+        # unlike acquireLease, a lease that was released or taken over in the meantime doesn't count
+        result = await self.db.get_collection(AntifreezeRoom).update_one(
+            {+AntifreezeRoom.roomId: roomId, +AntifreezeRoom.leaseOwner: owner},
+            {"$set": {+AntifreezeRoom.leaseUntil: until}},
+        )
+        return result.matched_count > 0
+
+    async def renewLeases(self, owner: str, roomIds: list[int], until: datetime):
+        await self.db.get_collection(AntifreezeRoom).update_many(
+            {+AntifreezeRoom.roomId: {"$in": roomIds}, +AntifreezeRoom.leaseOwner: owner},
+            {"$set": {+AntifreezeRoom.leaseUntil: until}},
+        )
+
+    async def releaseLeases(self, owner: str, roomIds: Optional[list[int]] = None):
+        query = {+AntifreezeRoom.leaseOwner: owner}
+        if roomIds is not None:
+            query[+AntifreezeRoom.roomId] = {"$in": roomIds}
+        await self.db.get_collection(AntifreezeRoom).update_many(
+            query, {"$set": {+AntifreezeRoom.leaseOwner: None, +AntifreezeRoom.leaseUntil: None}}
+        )
+
+    async def activeRoomIds(self) -> list[int]:
+        return [
+            doc["_id"]
+            async for doc in self.db.get_collection(AntifreezeRoom).find(
+                {+AntifreezeRoom.active: True}, {"_id": 1}
+            )
+        ]
+
+    async def recordActivity(self, roomId: int, at: datetime):
+        await self.db.get_collection(AntifreezeRoom).update_one(
+            {+AntifreezeRoom.roomId: roomId}, {"$max": {+AntifreezeRoom.lastActivity: at}}
+        )
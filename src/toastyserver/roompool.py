@@ -0,0 +1,109 @@
+from asyncio import Lock
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from logging import Logger
+from time import monotonic
+
+from aiohttp import ClientError
+from sechat import Credentials, Room
+
+from toastyserver.ratelimit import RateLimiter
+from toastyserver.metrics import JOIN_LATENCY, POOL_REUSES, POOL_SIZE, phase
+
+
+@dataclass
+class PooledRoom:
+    room: Room
+    stack: AsyncExitStack
+    lastUsed: float
+
+
+class RoomPool:
+    # Keeps rooms joined between sends, so a burst of messages pays for each join once
+    def __init__(self, credentials: Credentials, limiter: RateLimiter, maxsize: int, idleTimeout: float, logger: Logger):
+        self.credentials = credentials
+        self.limiter = limiter
+        self.maxsize = maxsize
+        self.idleTimeout = idleTimeout
+        self.logger = logger
+        self.rooms: OrderedDict[int, PooledRoom] = OrderedDict()
+        self.locks: dict[int, Lock] = {}
+        # coroutines currently joining or sending to each room; those rooms are never evicted
+        self.users: dict[int, int] = {}
+        POOL_SIZE.collect(lambda: [(("rooms",), self.size)])
+
+    @property
+    def size(self) -> int:
+        return len(self.rooms)
+
+    async def join(self, roomId: int) -> PooledRoom:
+        with phase("join"):
+            await self.limiter.acquire(self.credentials.server)
+            started = monotonic()
+            stack = AsyncExitStack()
+            room = await stack.enter_async_context(await Room.join(self.credentials, roomId))
+        latency = monotonic() - started
+        JOIN_LATENCY.observe(latency)
+        self.logger.debug(f"Joined {roomId} in {latency * 1000:.0f}ms ({self.size + 1} rooms pooled)")
+        return PooledRoom(room, stack, monotonic())
+
+    async def release(self, roomId: int):
+        if roomId not in self.users:
+            # nobody is waiting on it, and it's made again by the next use
+            self.locks.pop(roomId, None)
+        if (entry := self.rooms.pop(roomId, None)) is None:
+            return
+        try:
+            await entry.stack.aclose()
+        except Exception:
+            self.logger.exception(f"Failed to leave {roomId}")
+
+    @asynccontextmanager
+    async def use(self, roomId: int, fresh: bool = False):
+        self.users[roomId] = self.users.get(roomId, 0) + 1
+        try:
+            async with self.locks.setdefault(roomId, Lock()):
+                if fresh:
+                    await self.release(roomId)
+                if (entry := self.rooms.get(roomId)) is None:
+                    entry = self.rooms[roomId] = await self.join(roomId)
+                else:
+                    POOL_REUSES.inc()
+                entry.lastUsed = monotonic()
+                self.rooms.move_to_end(roomId)
+            yield entry.room
+        finally:
+            if users := self.users[roomId] - 1:
+                self.users[roomId] = users
+            else:
+                del self.users[roomId]
+                if roomId not in self.rooms:
+                    self.locks.pop(roomId, None)
+        # over the limit, leave the least recently used rooms that nobody is in the middle of using
+        for roomId in [roomId for roomId in self.rooms if roomId not in self.users][: max(0, self.size - self.maxsize)]:
+            await self.release(roomId)
+
+    async def send(self, roomId: int, message: str):
+        for attempt in range(2):
+            try:
+                async with self.use(roomId, fresh=attempt > 0) as room:
+                    with phase("send"):
+                        await self.limiter.acquire(self.credentials.server)
+                        return await room.send(message)
+            except (ClientError, ConnectionError):
+                # the pooled connection went away underneath us; rejoin once and try again
+                if attempt > 0:
+                    raise
+                self.logger.info(f"Connection to {roomId} was lost, rejoining")
+
+    async def evictIdle(self):
+        cutoff = monotonic() - self.idleTimeout
+        for roomId in [
+            roomId for roomId, entry in self.rooms.items() if entry.lastUsed < cutoff and roomId not in self.users
+        ]:
+            await self.release(roomId)
+
+    async def close(self):
+        for roomId in list(self.rooms):
+            await self.release(roomId)
@@ -0,0 +1,87 @@
+from asyncio import CancelledError, Task, create_task, sleep
+from datetime import datetime, timedelta
+from logging import Logger
+from typing import Optional
+from urllib.parse import urlencode
+
+from flask import Config
+from odmantic import AIOEngine
+from pymongo import ReplaceOne
+
+from toastyserver.httppool import HttpPool
+from toastyserver.models import Site
+
+
+class SiteMap:
+    # Site URL to API site parameter. Kept in mongo and refreshed in the background, so neither startup
+    # nor logins have to wait on the SE API, and an outage only means the map gets a bit stale.
+    def __init__(self, config: Config, db: AIOEngine, http: HttpPool, logger: Logger):
+        self.config = config
+        self.db = db
+        self.http = http
+        self.logger = logger
+        self.interval = timedelta(hours=int(config.get("SITEMAP_REFRESH", 24)))
+        self.sites: dict[str, str] = {}
+        self.refreshed: Optional[datetime] = None
+        self.attempted: Optional[datetime] = None
+        self.task: Optional[Task] = None
+
+    async def lookup(self, url: str) -> Optional[str]:
+        # a site we haven't heard of, or a map that has never been fetched, is worth one refresh on demand, but
+        # not one per login while SE is down
+        if url not in self.sites and (self.attempted is None or datetime.now() - self.attempted >= timedelta(minutes=1)):
+            try:
+                await self.refresh()
+            except Exception:
+                self.logger.exception("Refreshing the site map on demand failed")
+        return self.sites.get(url)
+
+    async def load(self):
+        async for site in self.db.find(Site):
+            self.sites[site.url] = site.apiSiteParameter
+            self.refreshed = site.refreshed if self.refreshed is None else min(self.refreshed, site.refreshed)
+
+    async def refresh(self):
+        self.attempted = datetime.now()
+        async with self.http.session("https://api.stackexchange.com").get(
+            "https://api.stackexchange.com/2.3/sites?{}".format(
+                urlencode(
+                    {
+                        "filter": "!b1aoo7vBeKCks8",
+                        "key": self.config["REQUEST_KEY"],
+                    }
+                )
+            )
+        ) as response:
+            items = (await response.json())["items"]
+        now = datetime.now()
+        sites = [Site(url=item["site_url"], apiSiteParameter=item["api_site_parameter"], refreshed=now) for item in items]
+        await self.db.get_collection(Site).bulk_write(
+            [ReplaceOne({"_id": site.url}, site.model_dump_doc(), upsert=True) for site in sites]
+        )
+        self.sites = {site.url: site.apiSiteParameter for site in sites}
+        self.refreshed = now
+        self.logger.info(f"Refreshed {len(sites)} sites")
+
+    async def keepFresh(self):
+        while True:
+            if self.refreshed is None or datetime.now() - self.refreshed >= self.interval:
+                try:
+                    await self.refresh()
+                except CancelledError:
+                    raise
+                except Exception:
+                    self.logger.exception("Refreshing the site map failed; keeping the stored one")
+            await sleep(60 if self.refreshed is None else max(60, (self.refreshed + self.interval - datetime.now()).total_seconds()))
+
+    def start(self):
+        self.task = create_task(self.keepFresh())
+
+    async def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,50 @@
+from asyncio import Queue, Task, create_task, gather, get_running_loop
+from typing import Awaitable, Callable
+from logging import Logger
+
+from toastyserver.ratelimit import Throttled
+
+
+class Sweeper:
+    def __init__(self, check: Callable[[int], Awaitable[None]], concurrency: int, logger: Logger):
+        self.check = check
+        self.concurrency = concurrency
+        self.logger = logger
+        self.queue: Queue[int] = Queue()
+        self.queued: set[int] = set()
+        self.workers: list[Task] = []
+
+    def start(self):
+        self.workers = [create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def shutdown(self):
+        for worker in self.workers:
+            worker.cancel()
+        await gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, roomId: int):
+        if roomId in self.queued:
+            return
+        self.queued.add(roomId)
+        self.queue.put_nowait(roomId)
+
+    def cancel(self, roomId: int):
+        self.queued.discard(roomId)
+
+    async def worker(self):
+        while True:
+            roomId = await self.queue.get()
+            try:
+                if roomId not in self.queued:
+                    continue
+                self.queued.discard(roomId)
+                await self.check(roomId)
+            except Throttled as error:
+                # being throttled isn't the room's fault, so put it back instead of recording an error
+                self.logger.warning(f"Throttled by {error.server} while checking room {roomId}, retrying in {error.retryAfter}s")
+                get_running_loop().call_later(error.retryAfter, self.submit, roomId)
+            except Exception:
+                self.logger.exception(f"Checking room {roomId} failed")
+            finally:
+                self.queue.task_done()
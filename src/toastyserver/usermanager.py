@@ -9,10 +9,14 @@ from odmantic import AIOEngine
 from odmantic.session import AIOSession
 
 from toastyserver.models import User, Token, Role
+from toastyserver.cache import TTLCache
+from toastyserver.metrics import instrumented, untimed
 
+@instrumented
 class UserManager:
-    def __init__(self, db: AIOEngine):
+    def __init__(self, db: AIOEngine, tokens: TTLCache[str, tuple[User, Token]]):
         self.db = db
+        self.tokens = tokens
 
     def requireUser(self, minRole: Role = Role.LOCKED):
         def decorator(function: Callable):
@@ -25,6 +29,7 @@ class UserManager:
                     return redirect(url_for("login") + "?" + urlencode({"redirect": request.path}))
                 assert token is not None
                 if datetime.now() > token.expiry:
+                    self.tokens.invalidate(token.token)
                     await self.db.delete(token)
                     return redirect(url_for("login") + "?" + urlencode({"redirect": request.path}))
                 if user.role.value < minRole.value:
@@ -41,23 +46,43 @@ class UserManager:
             else:
                 user, token = await self.getUserByToken(request.cookies["token"])
                 if token is not None and datetime.now() > token.expiry:
+                    self.tokens.invalidate(token.token)
                     await self.db.delete(token)
                     return redirect(url_for("login?{}".format(urlencode({"redirect": request.path}))))
             return await current_app.ensure_async(func)(*args, user=user, **kwargs)
         return decorator
             
-    async def allUsers(self):
-        return self.db.find(User)
+    async def allUsers(self, after: Optional[int] = None, limit: int = 0):
+        return self.db.find(
+            User, {} if after is None else User.ident > after, sort=User.ident, limit=limit or None
+        )
 
     async def userExists(self, ident: int, session: Optional[AIOSession] = None) -> bool:
         return True if (user := await self.db.find_one(User, User.ident == ident, session=session)) is not None else False
 
     async def saveUser(self, user: User, session: Optional[AIOSession] = None):
         await self.db.save(user, session=session)
+        self.tokens.invalidateWhere(lambda token, cached: cached[0].ident == user.ident)
 
+    async def updateUser(self, ident: int, **fields) -> bool:
+        result = await self.db.get_collection(User).update_one(
+            {+User.ident: ident}, {"$set": {+getattr(User, name): value for name, value in fields.items()}}
+        )
+        self.tokens.invalidateWhere(lambda token, cached: cached[0].ident == ident)
+        return result.matched_count > 0
+
+    @untimed
     async def getUserByToken(self, token: str, session: Optional[AIOSession] = None) -> tuple[Optional[User], Optional[Token]]:
+        if (cached := self.tokens.get(token)) is not None:
+            return cached
+        return await self.findUserByToken(token)
+
+    async def findUserByToken(self, token: str) -> tuple[Optional[User], Optional[Token]]:
         if (tokenModel := (await self.db.find_one(Token, Token.token == token))) is None:
             return None, None
+        # never cache a token past its expiry, so the expiry checks still see it and clean it up
+        if (ttl := min(self.tokens.ttl, (tokenModel.expiry - datetime.now()).total_seconds())) > 0:
+            self.tokens.set(token, (tokenModel.user, tokenModel), ttl)
         return tokenModel.user, tokenModel
 
     async def getUser(self, ident: int, session: Optional[AIOSession] = None) -> Optional[User]:
@@ -69,6 +94,7 @@ class UserManager:
         return token
 
     async def revokeToken(self, token: str):
+        self.tokens.invalidate(token)
         tokenModel = await self.db.find_one(Token, Token.token == token)
         assert tokenModel is not None
         await self.db.delete(tokenModel)
\ No newline at end of file